@@ -5,6 +5,12 @@ import uuid
 import logging
 import sys
 
+# Shared helpers live next to the client in the container and at the
+# repository root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.compression import post_json, response_json
+from common.readiness import wait_until_ready
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -34,14 +40,15 @@ async def run_pipeline(text: str, service1_url: str = SERVICE1_URL):
             }
             
             logger.info("CLIENT: Sending request to Service 1...")
-            response = await client.post(
+            response = await post_json(
+                client,
                 f"{service1_url}/process",
-                json=request_data,
+                request_data,
                 timeout=60.0
             )
             response.raise_for_status()
             
-            result = response.json()
+            result = response_json(response)
             
             logger.info("\nCLIENT: ===== Pipeline Complete =====")
             logger.info(f"CLIENT: Status: {result.get('status')}")
@@ -100,8 +107,9 @@ async def main():
         return
 
     logger.info("CLIENT: Waiting for services to be ready...")
-    # Increased sleep time for larger models or slower systems
-    await asyncio.sleep(5)
+    if not await wait_until_ready(SERVICE1_URL):
+        logger.error(f"CLIENT: {SERVICE1_URL} did not become ready")
+        sys.exit(1)
     
     try:
         result = await run_pipeline(test_text)
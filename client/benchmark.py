@@ -11,6 +11,14 @@ import uuid
 import os
 import glob
 
+# Shared helpers live next to the client in the container and at the
+# repository root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.chunking import split_text
+from common.compression import post_json, response_json
+from common.readiness import wait_until_ready
+
 def load_dataset_files(datasets_path='/app/datasets'):
     """Load text from dataset files"""
     text_files = []
@@ -49,13 +57,14 @@ async def run_single_test(session, text, service1_address='http://service1-loadb
     start_time = time.time()
     
     try:
-        response = await session.post(
+        response = await post_json(
+            session,
             f"{service1_address}/process",
-            json={"text": text, "request_id": request_id},
+            {"text": text, "request_id": request_id},
             timeout=300.0
         )
         response.raise_for_status()
-        result = response.json()
+        result = response_json(response)
         elapsed_time = time.time() - start_time
         return elapsed_time, True, result.get('word_count', 0)
         
@@ -65,25 +74,9 @@ async def run_single_test(session, text, service1_address='http://service1-loadb
         return elapsed_time, False, 0
 
 async def run_parallel_test(text, num_parallel, service1_address='http://service1-loadbalancer:8061'):
-    """Run parallel pipeline test with chunking"""
-        
-    def split_text_into_chunks(text, num_chunks):
-        """Split text into chunks"""
-        text_length = len(text)
-        chunk_size = text_length // num_chunks
-        chunks = []
-        
-        for i in range(num_chunks):
-            start = i * chunk_size
-            if i == num_chunks - 1:
-                end = text_length
-            else:
-                end = (i + 1) * chunk_size
-            chunks.append(text[start:end])
-        
-        return chunks
+    """Run parallel pipeline test with word-aligned chunking"""
     
-    chunks = split_text_into_chunks(text, num_parallel)
+    chunks = [chunk.text() for chunk in split_text(text, num_parallel, min_chunk_bytes=1)]
     request_id_base = str(uuid.uuid4())[:8]
     
     overall_start = time.time()
@@ -247,7 +240,9 @@ async def run_comprehensive_benchmark():
 if __name__ == '__main__':
     async def main():
         print("⏳ Waiting for services to be ready...")
-        await asyncio.sleep(10)
+        if not await wait_until_ready('http://service1-loadbalancer:8061'):
+            print("❌ Services did not become ready")
+            sys.exit(1)
         await run_comprehensive_benchmark()
     
     asyncio.run(main())
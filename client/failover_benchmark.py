@@ -0,0 +1,362 @@
+"""
+Failover and degradation benchmark with local fault injection.
+
+Runs the Service 1 load balancer locally against stand-in instances that
+can be told to add latency, answer with errors, hang, drop connections or
+go down entirely. Each scenario drives closed-loop load through the load
+balancer for three phases of FAILOVER_PHASE_SECONDS: before, during and
+after a fault on the first instance. Throughput, error rate and latency
+percentiles are reported per phase, together with how many attempts the
+load balancer made per request, so routing, retry and health-check changes
+can be compared quantitatively.
+
+Usage (from the repository root, with the load balancer's requirements
+installed): python client/failover_benchmark.py [scenario ...] [--json out.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import httpx
+
+# Shared helpers live next to the client in the container and at the
+# repository root during local development
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from common.compression import post_json
+from common.readiness import wait_until_ready
+
+# Configuration
+FAILOVER_INSTANCES = int(os.getenv("FAILOVER_INSTANCES", 4))
+FAILOVER_CONCURRENCY = int(os.getenv("FAILOVER_CONCURRENCY", 16))
+FAILOVER_PHASE_SECONDS = float(os.getenv("FAILOVER_PHASE_SECONDS", 10.0))
+FAILOVER_REQUEST_TIMEOUT = float(os.getenv("FAILOVER_REQUEST_TIMEOUT", 5.0))
+# Service time of a healthy stand-in, and what a slow one adds on top
+FAILOVER_BASE_LATENCY = float(os.getenv("FAILOVER_BASE_LATENCY", 0.005))
+FAILOVER_SLOW_LATENCY = float(os.getenv("FAILOVER_SLOW_LATENCY", 1.0))
+# A flapping instance goes down and comes back every period
+FAILOVER_FLAP_PERIOD = float(os.getenv("FAILOVER_FLAP_PERIOD", 1.0))
+FAILOVER_LB_PORT = int(os.getenv("FAILOVER_LB_PORT", 18061))
+# Load balancer output goes here (discarded when unset)
+FAILOVER_LB_LOG = os.getenv("FAILOVER_LB_LOG")
+
+LB_DIR = os.path.join(ROOT, "service1-loadbalancer")
+TEXT = "Docker is a platform for developing, shipping, and running applications in containers. " * 4
+
+# Scenario name -> fault of the first instance during the middle phase
+SCENARIOS = {
+    "baseline": None,
+    "slow": "slow",
+    "errors": "error",
+    "hang": "hang",
+    "drop": "drop",
+    "dead": "down",
+    "flapping": "flap",
+}
+PHASES = ("before", "during", "after")
+
+
+class StandInInstance:
+    """
+    Minimal HTTP/1.1 stand-in for a Service 1 instance serving /process,
+    /ready and /health, with an injectable fault:
+      slow   every response is FAILOVER_SLOW_LATENCY late
+      error  /process answers 500
+      hang   requests are never answered while the fault lasts
+      drop   connections are closed without an answer
+      down   the port is closed (connection refused), open connections reset
+    """
+
+    def __init__(self, name: str, port: int = 0):
+        self.name = name
+        self.port = port
+        self.fault: Optional[str] = None
+        # When each /process request arrived (monotonic)
+        self.attempts: List[float] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._writers = set()
+        self._healthy = asyncio.Event()
+        self._healthy.set()
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", self.port, reuse_address=True)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for writer in list(self._writers):
+            writer.close()
+        self._healthy.set()
+
+    async def set_fault(self, fault: Optional[str]):
+        previous, self.fault = self.fault, fault
+        if fault == "hang":
+            self._healthy.clear()
+        else:
+            self._healthy.set()
+        if fault == "down" and previous != "down":
+            await self.stop()
+        elif previous == "down" and fault != "down":
+            await self.start()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get("content-length", 0)))
+                if not await self._respond(path, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, path: str, writer: asyncio.StreamWriter) -> bool:
+        """Answer one request, False when the connection is to be closed instead"""
+        if path.startswith("/process"):
+            self.attempts.append(time.monotonic())
+        if self.fault == "drop":
+            return False
+        if self.fault == "hang":
+            await self._healthy.wait()
+            return False
+        if self.fault == "slow":
+            await asyncio.sleep(FAILOVER_SLOW_LATENCY)
+
+        status, body = 404, {"detail": "Not Found"}
+        if path.startswith("/process"):
+            await asyncio.sleep(FAILOVER_BASE_LATENCY)
+            if self.fault == "error":
+                status, body = 500, {"detail": f"Injected error at {self.name}"}
+            else:
+                status, body = 200, {"status": "success", "message": "Stand-in", "word_count": len(TEXT.split()),
+                                     "report": "", "top_words": []}
+        elif path.startswith("/ready") or path.startswith("/health"):
+            status, body = 200, {"ready": True, "service": self.name}
+
+        payload = json.dumps(body).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"content-type: application/json\r\ncontent-length: {len(payload)}\r\n"
+            f"connection: keep-alive\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+        return True
+
+
+async def start_load_balancer(instances: List[StandInInstance]) -> asyncio.subprocess.Process:
+    """Launch the Service 1 load balancer in front of the stand-ins"""
+    env = {
+        **os.environ,
+        "SERVICE1_INSTANCES": ",".join(instance.address for instance in instances),
+        "SERVICE_PORT": str(FAILOVER_LB_PORT),
+        "HOST": "127.0.0.1",
+    }
+    output = open(FAILOVER_LB_LOG, "ab") if FAILOVER_LB_LOG else asyncio.subprocess.DEVNULL
+    return await asyncio.create_subprocess_exec(
+        sys.executable, "app.py", cwd=LB_DIR, env=env, stdout=output, stderr=output
+    )
+
+
+async def stop_load_balancer(process: asyncio.subprocess.Process):
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), 10.0)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def wait_until_balanced(client: httpx.AsyncClient, url: str, timeout: float = 60.0) -> bool:
+    """Wait until every instance is ready and past slow start, so the before phase sees full traffic"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            readiness = (await client.get(f"{url}/stats")).json()["readiness"]
+            if readiness and all(state["weight"] >= 1.0 for state in readiness.values()):
+                return True
+        except (httpx.HTTPError, KeyError, ValueError):
+            pass
+        await asyncio.sleep(0.5)
+    return False
+
+
+async def generate_load(url: str, t0: float, stop_at: float) -> List[Tuple[float, float, bool]]:
+    """Closed-loop load from FAILOVER_CONCURRENCY workers, one (start, latency, ok) per request"""
+    records = []
+    limits = httpx.Limits(max_connections=FAILOVER_CONCURRENCY, max_keepalive_connections=FAILOVER_CONCURRENCY)
+
+    async with httpx.AsyncClient(limits=limits) as client:
+        async def worker(worker_id: int):
+            sequence = 0
+            while time.monotonic() < stop_at:
+                start = time.monotonic()
+                try:
+                    response = await post_json(
+                        client, f"{url}/process",
+                        {"text": TEXT, "request_id": f"failover-{worker_id}-{sequence}"},
+                        timeout=FAILOVER_REQUEST_TIMEOUT
+                    )
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                end = time.monotonic()
+                records.append((start - t0, end - start, ok))
+                sequence += 1
+                if not ok:
+                    # Fast failures would otherwise spin the worker
+                    await asyncio.sleep(0.01)
+
+        await asyncio.gather(*[worker(i) for i in range(FAILOVER_CONCURRENCY)])
+    return records
+
+
+async def inject_fault(instance: StandInInstance, fault: Optional[str], until: float):
+    """Apply fault to instance until the monotonic time until, then heal it"""
+    if fault == "flap":
+        down = True
+        while time.monotonic() < until:
+            await instance.set_fault("down" if down else None)
+            down = not down
+            await asyncio.sleep(min(FAILOVER_FLAP_PERIOD, max(0.0, until - time.monotonic())))
+    elif fault is not None:
+        await instance.set_fault(fault)
+        await asyncio.sleep(max(0.0, until - time.monotonic()))
+    await instance.set_fault(None)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(records: List[Tuple[float, float, bool]], attempts: List[float], phase: int) -> dict:
+    """
+    Metrics of the requests started during phase (0: before, 1: during,
+    2: after), attempts being when the instances received them (seconds
+    since the start of the load)
+    """
+    start, end = phase * FAILOVER_PHASE_SECONDS, (phase + 1) * FAILOVER_PHASE_SECONDS
+    in_phase = [(latency, ok) for started, latency, ok in records if start <= started < end]
+    phase_attempts = sum(1 for attempt in attempts if start <= attempt < end)
+    latencies = [latency for latency, _ in in_phase]
+    errors = sum(1 for _, ok in in_phase if not ok)
+    return {
+        "requests": len(in_phase),
+        "throughput": round((len(in_phase) - errors) / FAILOVER_PHASE_SECONDS, 1),
+        "error_rate": round(errors / len(in_phase) * 100, 2) if in_phase else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+        "attempts_per_request": round(phase_attempts / len(in_phase), 3) if in_phase else 0.0,
+    }
+
+
+async def run_scenario(name: str) -> dict:
+    fault = SCENARIOS[name]
+    url = f"http://127.0.0.1:{FAILOVER_LB_PORT}"
+    instances = [StandInInstance(f"stand-in-{i}") for i in range(FAILOVER_INSTANCES)]
+    for instance in instances:
+        await instance.start()
+    process = await start_load_balancer(instances)
+
+    try:
+        if not await wait_until_ready(url, timeout=60.0):
+            raise RuntimeError("Load balancer did not become ready")
+        async with httpx.AsyncClient() as client:
+            if not await wait_until_balanced(client, url):
+                print("  ⚠️  Instances still in slow start, measuring anyway")
+
+            print(f"\n🧪 {name}: fault '{fault or 'none'}' on {instances[0].name} "
+                  f"from {FAILOVER_PHASE_SECONDS:.0f}s to {2 * FAILOVER_PHASE_SECONDS:.0f}s")
+            t0 = time.monotonic()
+            load = asyncio.create_task(generate_load(url, t0, t0 + 3 * FAILOVER_PHASE_SECONDS))
+            await asyncio.sleep(FAILOVER_PHASE_SECONDS)
+            await inject_fault(instances[0], fault, t0 + 2 * FAILOVER_PHASE_SECONDS)
+            records = await load
+
+            lb_stats = (await client.get(f"{url}/stats")).json()
+    finally:
+        await stop_load_balancer(process)
+        for instance in instances:
+            await instance.stop()
+
+    attempts = [attempt - t0 for instance in instances for attempt in instance.attempts]
+    return {
+        "scenario": name,
+        "fault": fault,
+        "phases": {phase: summarize(records, attempts, i) for i, phase in enumerate(PHASES)},
+        "instance_attempts": {instance.name: len(instance.attempts) for instance in instances},
+        "retry_budget": lb_stats.get("retry_budget"),
+    }
+
+
+def print_results(results: List[dict]):
+    print("\n" + "=" * 96)
+    print("📊 FAILOVER BENCHMARK RESULTS")
+    print("=" * 96)
+    print(f"{FAILOVER_INSTANCES} stand-ins, {FAILOVER_CONCURRENCY} concurrent clients, "
+          f"{FAILOVER_PHASE_SECONDS:.0f}s per phase, {FAILOVER_REQUEST_TIMEOUT:.1f}s request timeout")
+    print(f"{'Scenario':<10} {'Phase':<7} {'Requests':>9} {'OK req/s':>9} {'Errors %':>9} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'Attempts/req':>13}")
+    print("-" * 96)
+    for result in results:
+        for phase in PHASES:
+            metrics = result["phases"][phase]
+            print(f"{result['scenario']:<10} {phase:<7} {metrics['requests']:>9} {metrics['throughput']:>9.1f} "
+                  f"{metrics['error_rate']:>9.2f} {metrics['p50_ms']:>9.1f} {metrics['p99_ms']:>9.1f} "
+                  f"{metrics['max_ms']:>9.1f} {metrics['attempts_per_request']:>13.3f}")
+    print("=" * 96)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Failover and degradation benchmark with local fault injection")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"scenarios to run, of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--json", help="also write the results to this file, for comparing runs")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    results = []
+    for name in args.scenarios or list(SCENARIOS):
+        results.append(await run_scenario(name))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results written to {args.json}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -7,51 +7,117 @@ import os
 import glob
 
 sys.path.insert(0, '/app')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.chunking import split_text
+from common.compression import post_json, response_json
+from common.readiness import wait_until_ready
+
+# "static" sends one equal-sized chunk per pipeline, "work-stealing" schedules
+# many smaller work units over an adaptively sized pool of in-flight slots
+SCHEDULER_MODE = os.getenv("PARALLEL_SCHEDULER", "static")
+UNITS_PER_SLOT = int(os.getenv("PARALLEL_UNITS_PER_SLOT", 4))
+MAX_UNIT_RETRIES = int(os.getenv("PARALLEL_MAX_UNIT_RETRIES", 2))
+SLOTS_PER_INSTANCE = int(os.getenv("PARALLEL_SLOTS_PER_INSTANCE", 2))
+
+class AdaptiveConcurrency:
+    """
+    Bounded in-flight limit tuned by hill climbing on observed throughput:
+    after every window of completed units the limit moves one step in the
+    current direction, and the direction flips when throughput dropped.
+    """
+    def __init__(self, initial, minimum, maximum, window=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.window = window or self.limit
+        self.in_flight = 0
+        self.history = [self.limit]
+        self._condition = asyncio.Condition()
+        self._direction = 1
+        self._last_throughput = 0.0
+        self._window_bytes = 0
+        self._window_completed = 0
+        self._window_start = time.time()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def cancel(self):
+        """Give back a slot that was acquired but never used"""
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    async def release(self, nbytes):
+        async with self._condition:
+            self.in_flight -= 1
+            self._window_bytes += nbytes
+            self._window_completed += 1
+            if self._window_completed >= self.window:
+                self._retune()
+            self._condition.notify_all()
+
+    def _retune(self):
+        elapsed = time.time() - self._window_start
+        throughput = self._window_bytes / elapsed if elapsed > 0 else 0.0
+        if throughput < self._last_throughput:
+            self._direction = -self._direction
+        self._last_throughput = throughput
+        self.limit = min(max(self.limit + self._direction, self.minimum), self.maximum)
+        if self.limit in (self.minimum, self.maximum):
+            self._direction = 1 if self.limit == self.minimum else -1
+        self.history.append(self.limit)
+        self.window = self.limit
+        self._window_bytes = 0
+        self._window_completed = 0
+        self._window_start = time.time()
 
 class ParallelPipelineClient:
     def __init__(self):
         self.service1_lb = 'http://service1-loadbalancer:8061'
+        self.service4_lb = 'http://service4-loadbalancer:8064'
+        self.lb_stats_urls = [
+            'http://service1-loadbalancer:8061',
+            'http://service2-loadbalancer:8062',
+            'http://service3-loadbalancer:8063',
+            'http://service4-loadbalancer:8064'
+        ]
         self.num_parallel_pipelines = 4
+        self.scheduler_mode = SCHEDULER_MODE
 
     def split_text_into_chunks(self, text, num_chunks):
-        text_length = len(text)
-        if text_length > 5 * 1024 * 1024:
-            print(f"📊 Large file detected: {text_length:,} characters, using optimized chunking...")
-            chunk_size = text_length // num_chunks
-            chunks = []
-            for i in range(num_chunks):
-                start = i * chunk_size
-                end = text_length if i == num_chunks - 1 else (i + 1) * chunk_size
-                chunks.append(text[start:end])
-        else:
-            words = text.split()
-            chunk_size = len(words) // num_chunks
-            chunks = []
-            for i in range(num_chunks):
-                start = i * chunk_size
-                end = len(words) if i == num_chunks - 1 else (i + 1) * chunk_size
-                chunks.append(' '.join(words[start:end]))
-        
-        print(f"Split {text_length:,} characters into {num_chunks} chunks:")
-        for i, chunk in enumerate(chunks):
-            word_count = len(chunk.split())
-            print(f"  Chunk {i+1}: {word_count:,} words, {len(chunk):,} chars")
+        chunks = split_text(text, num_chunks)
+        total_bytes = chunks[-1].end if chunks else 0
+        print(f"Split {len(text):,} characters ({total_bytes:,} bytes) into {len(chunks)} word-aligned chunks:")
+        for chunk in chunks:
+            print(f"  Chunk {chunk.index+1}: {chunk.size:,} bytes [{chunk.start:,}-{chunk.end:,})")
         return chunks
 
-    async def process_single_chunk(self, client, chunk_text, chunk_id, request_id_base):
+    async def process_single_chunk(self, client, chunk, chunk_id, request_id_base, total_chunks=None):
         request_id = f"{request_id_base}_chunk{chunk_id}"
         print(f"\n[Pipeline {chunk_id}] Starting processing...")
-        print(f"[Pipeline {chunk_id}] Chunk size: {len(chunk_text):,} chars, {len(chunk_text.split()):,} words")
+        print(f"[Pipeline {chunk_id}] Chunk size: {chunk.size:,} bytes")
         start_time = time.time()
 
         try:
-            response = await client.post(
+            response = await post_json(
+                client,
                 f"{self.service1_lb}/process",
-                json={"text": chunk_text, "request_id": request_id},
+                {
+                    "text": chunk.text(),
+                    "request_id": request_id,
+                    # Tags the chunk so service4 merges it into one job report
+                    "job_id": request_id_base,
+                    "chunk_index": chunk_id,
+                    "total_chunks": total_chunks
+                },
                 timeout=300.0
             )
             response.raise_for_status()
-            result = response.json()
+            result = response_json(response)
             elapsed_time = time.time() - start_time
             print(f"[Pipeline {chunk_id}] ✓ Completed in {elapsed_time:.3f}s - {result.get('word_count', 0):,} words")
             return {
@@ -73,8 +139,12 @@ class ParallelPipelineClient:
                 'processing_time': elapsed_time
             }
 
-    async def process_parallel(self, text, num_parallel=None):
+    async def process_parallel(self, text, num_parallel=None, mode=None):
         num_parallel = num_parallel or self.num_parallel_pipelines
+        mode = mode or self.scheduler_mode
+        if mode == "work-stealing":
+            return await self.process_work_stealing(text, num_parallel)
+
         print("\n" + "="*80)
         print("🚀 PARALLEL PIPELINE PROCESSING")
         print("="*80)
@@ -85,17 +155,96 @@ class ParallelPipelineClient:
 
         chunks = self.split_text_into_chunks(text, num_parallel)
         request_id_base = str(uuid.uuid4())[:8]
-        print(f"\nStarting {num_parallel} parallel pipelines...")
+        print(f"\nStarting {len(chunks)} parallel pipelines...")
         overall_start = time.time()
 
         async with httpx.AsyncClient() as client:
-            tasks = [self.process_single_chunk(client, chunk, i, request_id_base) for i, chunk in enumerate(chunks)]
+            tasks = [self.process_single_chunk(client, chunk, i, request_id_base, len(chunks)) for i, chunk in enumerate(chunks)]
             results = await asyncio.gather(*tasks)
+            overall_time = time.time() - overall_start
+            merged = await self.fetch_merged_report(client, request_id_base)
+
+        return self.aggregate_results(results, overall_time, merged)
+
+    async def fetch_merged_report(self, client, job_id):
+        """Fetch the job report service4 merged from every chunk's analysis"""
+        try:
+            response = await client.get(f"{self.service4_lb}/reduce/{job_id}", timeout=30.0)
+            response.raise_for_status()
+            return response_json(response)
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"⚠️  Could not fetch merged report for job {job_id}: {str(e)}")
+            return None
+
+    async def fetch_instance_capacity(self, client):
+        """Smallest healthy instance count across the load balancers' /stats"""
+        counts = []
+        for url in self.lb_stats_urls:
+            try:
+                response = await client.get(f"{url}/stats", timeout=5.0)
+                response.raise_for_status()
+                counts.append(len(response.json().get('instances', [])))
+            except (httpx.HTTPError, ValueError) as e:
+                print(f"⚠️  Could not read {url}/stats: {str(e)}")
+        counts = [c for c in counts if c > 0]
+        return min(counts) if counts else None
 
-        overall_time = time.time() - overall_start
-        return self.aggregate_results(results, overall_time)
+    async def process_work_stealing(self, text, num_parallel=None):
+        num_parallel = num_parallel or self.num_parallel_pipelines
+        print("\n" + "="*80)
+        print("🚀 WORK-STEALING PIPELINE PROCESSING")
+        print("="*80)
+        print(f"Total text length: {len(text):,} characters")
+
+        async with httpx.AsyncClient() as client:
+            capacity = await self.fetch_instance_capacity(client)
+            max_slots = (capacity or num_parallel) * SLOTS_PER_INSTANCE
+            limiter = AdaptiveConcurrency(initial=num_parallel, minimum=1, maximum=max_slots)
+            print(f"Initial in-flight units: {limiter.limit} (max {limiter.maximum}, instances per stage: {capacity or 'unknown'})")
+
+            units = self.split_text_into_chunks(text, limiter.maximum * UNITS_PER_SLOT)
+            request_id_base = str(uuid.uuid4())[:8]
+            queue = asyncio.Queue()
+            for unit in units:
+                queue.put_nowait((unit, 1))
 
-    def aggregate_results(self, results, total_time):
+            results = {}
+
+            async def worker():
+                # Idle slots keep pulling units off the shared queue, so the
+                # remaining work flows to whichever pipelines are keeping up
+                while True:
+                    await limiter.acquire()
+                    try:
+                        unit, attempt = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        await limiter.cancel()
+                        return
+                    try:
+                        result = await self.process_single_chunk(client, unit, unit.index, request_id_base, len(units))
+                    finally:
+                        await limiter.release(unit.size)
+                    result['attempts'] = attempt
+                    if not result['success'] and attempt <= MAX_UNIT_RETRIES:
+                        print(f"[Pipeline {unit.index}] ↻ Retrying unit (attempt {attempt + 1})")
+                        queue.put_nowait((unit, attempt + 1))
+                    else:
+                        results[unit.index] = result
+                    queue.task_done()
+
+            overall_start = time.time()
+            workers = [asyncio.create_task(worker()) for _ in range(limiter.maximum)]
+            await queue.join()
+            await asyncio.gather(*workers)
+            overall_time = time.time() - overall_start
+            merged = await self.fetch_merged_report(client, request_id_base)
+
+        print(f"\nIn-flight limit history: {limiter.history}")
+        retried = sum(1 for r in results.values() if r['attempts'] > 1)
+        print(f"Units retried: {retried}/{len(units)}")
+        return self.aggregate_results([results[i] for i in sorted(results)], overall_time, merged)
+
+    def aggregate_results(self, results, total_time, merged=None):
         successful = [r for r in results if r['success']]
         failed = [r for r in results if not r['success']]
         total_words = sum(r['word_count'] for r in successful)
@@ -124,7 +273,12 @@ class ParallelPipelineClient:
             print("\nFailures:")
             for fail in failed:
                 print(f"  Pipeline {fail['chunk_id']}: {fail['error']}")
+        if merged:
+            print(f"\nMerged job report ({merged.get('status')}, {merged.get('chunks_received')}/{merged.get('total_chunks')} chunks):")
+            print(merged.get('report', ''))
+
         return {
+            'merged_report': merged,
             'total_time': total_time,
             'successful_count': len(successful),
             'failed_count': len(failed),
@@ -173,6 +327,11 @@ async def main():
     print("• Optimized chunking for different file sizes")
     print("="*80)
 
+    print("\nWaiting for services to be ready...")
+    if not await wait_until_ready(client.service1_lb):
+        print("Services did not become ready!")
+        return
+
     print("\nScanning for text files...")
     text_files = read_text_files('/app/datasets')
     if not text_files:
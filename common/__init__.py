@@ -0,0 +1 @@
+"""Helpers shared by the pipeline services, load balancers and clients"""
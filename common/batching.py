@@ -0,0 +1,121 @@
+"""
+Micro-batching of concurrent small requests.
+
+With MICRO_BATCH=true a stage hands requests of at most MICRO_BATCH_MAX_BYTES
+to a MicroBatcher instead of processing them one at a time. The first
+request of a batch opens a window of MICRO_BATCH_WINDOW seconds, and the
+batch is dispatched when the window closes or MICRO_BATCH_MAX_SIZE requests
+have joined, whichever comes first. The batch function processes the whole
+batch at once and returns one result (or exception) per request, which is
+handed back to the request waiting for it. A batch runs under the latest
+deadline of its requests (none if one of them has none), while each request
+still only waits until its own.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+from collections import Counter
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from common.deadline import DeadlineExceeded, current_deadline, set_deadline
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+MICRO_BATCH = os.getenv("MICRO_BATCH", "false").lower() == "true"
+MICRO_BATCH_MAX_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", 32))
+MICRO_BATCH_WINDOW = float(os.getenv("MICRO_BATCH_WINDOW", 0.005))
+# Larger requests are processed on their own
+MICRO_BATCH_MAX_BYTES = int(os.getenv("MICRO_BATCH_MAX_BYTES", 16 * 1024))
+
+
+class MicroBatcher:
+    def __init__(self, name: str, process: Callable[[list], Awaitable[list]],
+                 max_size: int = MICRO_BATCH_MAX_SIZE, window: float = MICRO_BATCH_WINDOW,
+                 max_bytes: int = MICRO_BATCH_MAX_BYTES):
+        self.name = name
+        self.process = process
+        self.enabled = MICRO_BATCH
+        self.max_size = max(1, max_size)
+        self.window = window
+        self.max_bytes = max_bytes
+        # (item, future, deadline) of the requests waiting for the open batch
+        self._pending: List[Tuple[Any, asyncio.Future, Optional[float]]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Batches being processed, referenced until they finish
+        self._running = set()
+        self.sizes = Counter()
+        self.stats_counters = {"batches": 0, "requests": 0, "flushed_full": 0, "flushed_window": 0,
+                               "timed_out": 0, "failed": 0}
+
+    def accepts(self, size: int) -> bool:
+        """Whether a request of size bytes (or characters) is batched"""
+        return self.enabled and size <= self.max_bytes
+
+    async def submit(self, item: Any, timeout: float) -> Any:
+        """Process item as part of a batch, waiting at most timeout seconds for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, current_deadline()))
+        if len(self._pending) >= self.max_size:
+            self._flush("full")
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush, "window")
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.stats_counters["timed_out"] += 1
+            raise DeadlineExceeded(f"No batched result within {timeout:.3f}s")
+
+    def _flush(self, reason: str):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        self.stats_counters["batches"] += 1
+        self.stats_counters["requests"] += len(batch)
+        self.stats_counters[f"flushed_{reason}"] += 1
+        self.sizes[len(batch)] += 1
+
+        deadlines = [deadline for _, _, deadline in batch]
+        context = contextvars.Context()
+        context.run(set_deadline, None if None in deadlines else max(deadlines))
+        task = asyncio.get_running_loop().create_task(self._run(batch), context=context)
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: list):
+        # Requests that gave up while the window was open are left out
+        batch = [entry for entry in batch if not entry[1].done()]
+        if not batch:
+            return
+        try:
+            results = await self.process([item for item, _, _ in batch])
+        except Exception as e:
+            logger.error(f"[{self.name}] Batch of {len(batch)} requests failed: {str(e)}")
+            self.stats_counters["failed"] += 1
+            results = [e] * len(batch)
+
+        for (_, future, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        batches = self.stats_counters["batches"]
+        return {
+            "enabled": self.enabled,
+            "max_size": self.max_size,
+            "window_seconds": self.window,
+            "max_bytes": self.max_bytes,
+            "pending": len(self._pending),
+            "mean_size": round(self.stats_counters["requests"] / batches, 2) if batches else 0.0,
+            "sizes": {str(size): count for size, count in sorted(self.sizes.items())},
+            **self.stats_counters
+        }
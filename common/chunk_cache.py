@@ -0,0 +1,95 @@
+"""
+Chunk-level caching for incremental re-processing.
+
+Documents of at least INCREMENTAL_MIN_BYTES are cut into content-defined
+chunks (see content_defined_offsets in common/chunking.py) keyed by a hash
+of their bytes. A stage caches its per-chunk output, so resubmitting a
+document that grew or was edited only recomputes the chunks that changed;
+the rest is merged from the cache. The cache is an in-process LRU bounded
+by the (approximate) bytes its entries hold; load balancers keep sending a
+document to the same instance (DOCUMENT_KEY_HEADER) while it is ready. With
+OFFLOAD_EXECUTOR=process every worker process keeps its own cache.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Iterator, Optional, Tuple
+
+from common.chunking import content_defined_offsets
+
+# Configuration
+INCREMENTAL = os.getenv("INCREMENTAL", "true").lower() == "true"
+# Smaller documents are processed whole
+INCREMENTAL_MIN_BYTES = int(os.getenv("INCREMENTAL_MIN_BYTES", 4 * 1024 * 1024))
+INCREMENTAL_CHUNK_BYTES = int(os.getenv("INCREMENTAL_CHUNK_BYTES", 1024 * 1024))
+CHUNK_CACHE_MAX_BYTES = int(os.getenv("CHUNK_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Identifies a document across resubmissions, so load balancers can send it
+# to the instance whose cache holds its chunks
+DOCUMENT_KEY_HEADER = "x-document-key"
+
+
+def use_incremental(size: int) -> bool:
+    """Whether a document of size bytes (or characters) is processed chunk by chunk"""
+    return INCREMENTAL and size >= INCREMENTAL_MIN_BYTES
+
+
+def document_key(text: Optional[str]) -> Optional[str]:
+    """
+    Hash of the start of a document processed chunk by chunk (None for
+    other documents). The start lies inside the first chunk, so the key
+    stays the same while the document grows or is edited further on.
+    """
+    if not text or not use_incremental(len(text)):
+        return None
+    return hashlib.blake2b(text[:INCREMENTAL_CHUNK_BYTES // 4].encode("utf-8"), digest_size=8).hexdigest()
+
+
+def content_chunks(data: bytes) -> Iterator[Tuple[str, memoryview]]:
+    """Yield (key, chunk) for the content-defined chunks of data"""
+    view = memoryview(data)
+    for start, end in content_defined_offsets(data, INCREMENTAL_CHUNK_BYTES):
+        chunk = view[start:end]
+        yield hashlib.blake2b(chunk, digest_size=16).hexdigest(), chunk
+
+
+class ChunkCache:
+    def __init__(self, name: str, max_bytes: int = CHUNK_CACHE_MAX_BYTES):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        # Stage functions may run on offload threads
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.stats_counters = {"hits": 0, "misses": 0, "evicted": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats_counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats_counters["hits"] += 1
+            return entry[0]
+
+    def put(self, key: str, value: Any, size: int):
+        """Cache value, which holds about size bytes, evicting least recently used entries"""
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.stats_counters["evicted"] += 1
+
+    def stats(self) -> dict:
+        return {"enabled": INCREMENTAL, "entries": len(self._entries), "bytes": self.bytes,
+                "max_bytes": self.max_bytes, **self.stats_counters}
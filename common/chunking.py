@@ -0,0 +1,140 @@
+"""
+Word-boundary-aware, byte-balanced text chunking.
+
+The document is encoded to UTF-8 once and cut into chunks of roughly equal
+byte size. Every cut is snapped to the nearest ASCII whitespace byte, which
+can never fall inside a UTF-8 multi-byte sequence or split a word, so the
+per-chunk word counts always add up to the word count of the whole text.
+Chunks are exposed as offsets plus a zero-copy memoryview; the text is never
+tokenized.
+"""
+
+import hashlib
+import re
+from typing import Iterator, List, NamedTuple, Optional, Union
+
+WHITESPACE_BYTES = (b' ', b'\n', b'\t', b'\r', b'\x0b', b'\x0c')
+
+# Do not cut chunks smaller than this, however many were requested
+MIN_CHUNK_BYTES = 4 * 1024
+
+
+class TextChunk(NamedTuple):
+    index: int
+    start: int
+    end: int
+    data: memoryview
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+    def text(self) -> str:
+        """Decode the chunk to str (a single copy of just this chunk)"""
+        return str(self.data, 'utf-8')
+
+
+def _nearest_whitespace(data: bytes, target: int, lo: int, hi: int) -> int:
+    """Return the whitespace offset in [lo, hi) closest to target, or -1"""
+    before = max((data.rfind(ws, lo, target + 1) for ws in WHITESPACE_BYTES), default=-1)
+    after = -1
+    for ws in WHITESPACE_BYTES:
+        pos = data.find(ws, target, hi)
+        if pos != -1 and (after == -1 or pos < after):
+            after = pos
+
+    if before == -1:
+        return after
+    if after == -1:
+        return before
+    return before if target - before <= after - target else after
+
+
+def chunk_offsets(data: bytes, num_chunks: int, min_chunk_bytes: int = MIN_CHUNK_BYTES) -> List[tuple]:
+    """
+    Compute (start, end) byte offsets of up to num_chunks word-aligned chunks.
+    Fewer chunks are returned when the text is too small or has too few
+    whitespace positions to cut at.
+    """
+    total = len(data)
+    if total == 0:
+        return []
+
+    num_chunks = max(1, min(num_chunks, total // max(1, min_chunk_bytes) or 1))
+    offsets = []
+    start = 0
+    for i in range(1, num_chunks):
+        target = total * i // num_chunks
+        if target <= start:
+            continue
+        cut = _nearest_whitespace(data, target, start + 1, total)
+        if cut <= start:
+            continue
+        offsets.append((start, cut))
+        start = cut
+    offsets.append((start, total))
+    return offsets
+
+
+def iter_chunks(text: Union[str, bytes], num_chunks: int,
+                min_chunk_bytes: int = MIN_CHUNK_BYTES) -> Iterator[TextChunk]:
+    """Yield word-aligned chunks of roughly equal byte size"""
+    data = text.encode('utf-8') if isinstance(text, str) else bytes(text)
+    view = memoryview(data)
+    for index, (start, end) in enumerate(chunk_offsets(data, num_chunks, min_chunk_bytes)):
+        yield TextChunk(index, start, end, view[start:end])
+
+
+def split_text(text: Union[str, bytes], num_chunks: int,
+               min_chunk_bytes: int = MIN_CHUNK_BYTES) -> List[TextChunk]:
+    """Split text into a list of word-aligned chunks"""
+    return list(iter_chunks(text, num_chunks, min_chunk_bytes))
+
+
+# Content-defined chunking. Every byte is mapped to one of four symbols (two
+# bits) by a fixed table, and a chunk ends at the first whitespace after
+# the last log2(avg_bytes) / 2 bytes spell a fixed anchor pattern: a rolling
+# hash whose window is the pattern length, evaluated with bytes.translate
+# and bytes.find at C speed. Cuts
+# depend only on nearby content, so appending to (or editing) a document
+# leaves the chunks before the change, and their cache keys, unchanged.
+_SYMBOL_TABLE = bytes.maketrans(bytes(range(256)), bytes(b'0123'[hashlib.blake2b(bytes([b])).digest()[0] & 3]
+                                                         for b in range(256)))
+_WHITESPACE = re.compile(rb'[ \n\t\r\x0b\x0c]')
+
+
+def _anchor(avg_bytes: int) -> bytes:
+    """Fixed pattern of about log2(avg_bytes) bits, found about every avg_bytes bytes of varied text"""
+    length = max(1, (avg_bytes.bit_length() - 1) // 2)
+    seed = hashlib.blake2b(b'anchor', digest_size=64).digest()
+    return bytes(b'0123'[seed[i % 64] & 3] for i in range(length))
+
+
+def content_defined_offsets(data: bytes, avg_bytes: int,
+                            min_bytes: Optional[int] = None, max_bytes: Optional[int] = None) -> List[tuple]:
+    """
+    Compute (start, end) byte offsets of word-aligned content-defined chunks
+    of about avg_bytes (at least min_bytes, default avg_bytes / 4, except the
+    last). A chunk without an anchor in its first max_bytes (default
+    4 * avg_bytes) is cut at the first whitespace after max_bytes.
+    """
+    min_bytes = avg_bytes // 4 if min_bytes is None else min_bytes
+    max_bytes = avg_bytes * 4 if max_bytes is None else max_bytes
+    pattern = _anchor(avg_bytes)
+    total = len(data)
+    offsets = []
+    start = 0
+    while start < total:
+        cut = -1
+        if total - start > min_bytes:
+            lo = max(start, start + min_bytes - len(pattern))
+            hi = min(total, start + max_bytes)
+            found = data[lo:hi].translate(_SYMBOL_TABLE).find(pattern)
+            if found != -1 or hi < total:
+                match = _WHITESPACE.search(data, lo + found + len(pattern) if found != -1 else hi)
+                cut = match.start() if match else -1
+        if cut <= start:
+            cut = total
+        offsets.append((start, cut))
+        start = cut
+    return offsets
@@ -0,0 +1,56 @@
+"""
+Direct-return completion path.
+
+In direct mode the entry point sends a callback_url down the pipeline.
+Every stage acknowledges as soon as it has accepted the work and continues
+in the background, and the final stage (or any stage that fails) posts the
+result straight to callback_url instead of unwinding it through every hop.
+"""
+
+import logging
+
+import httpx
+
+from common.compression import post_json
+from common.http_pool import shared_client
+
+logger = logging.getLogger(__name__)
+
+# Attempts to deliver a completion before giving up
+DELIVERY_ATTEMPTS = 3
+
+
+def completion_fields(request) -> dict:
+    """The callback_url of a request, for forwarding downstream"""
+    callback_url = getattr(request, "callback_url", None)
+    return {"callback_url": callback_url} if callback_url else {}
+
+
+def accepted(stage: str) -> dict:
+    """Acknowledgement returned by a stage that continues in the background"""
+    return {
+        "status": "accepted",
+        "message": f"{stage} accepted the request for direct completion",
+        "word_count": 0
+    }
+
+
+async def deliver(callback_url: str, result: dict) -> bool:
+    """POST a completion (result or error) to the entry point"""
+    for attempt in range(1, DELIVERY_ATTEMPTS + 1):
+        try:
+            response = await post_json(shared_client(), callback_url, result, timeout=10.0)
+            response.raise_for_status()
+            return True
+        except httpx.HTTPStatusError as e:
+            # The entry point no longer waits for this request
+            logger.error(f"[Completion] {callback_url} rejected completion: {str(e)}")
+            return False
+        except httpx.HTTPError as e:
+            logger.error(f"[Completion] Delivery attempt {attempt} to {callback_url} failed: {str(e)}")
+    return False
+
+
+async def deliver_error(callback_url: str, message: str) -> bool:
+    """Report a failed stage to the entry point"""
+    return await deliver(callback_url, {"status": "error", "message": message, "word_count": 0})
@@ -0,0 +1,252 @@
+"""
+Request/response body compression negotiated via Content-Encoding and
+Accept-Encoding.
+
+Outgoing JSON bodies at or above COMPRESSION_MIN_SIZE are compressed with the
+preferred available encoding (zstd when the zstandard package is installed,
+otherwise gzip). CompressionMiddleware decompresses incoming request bodies
+and compresses responses for callers that advertise support for it.
+"""
+
+import gzip
+import logging
+import os
+from typing import Optional, Tuple
+
+import httpx
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+from common.chunk_cache import DOCUMENT_KEY_HEADER, document_key
+from common.deadline import deadline_headers
+from common.fastjson import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 4096))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 1))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", 3))
+COMPRESSION_ENCODINGS = [
+    e.strip() for e in os.getenv("COMPRESSION_ENCODINGS", "zstd,gzip").split(",") if e.strip()
+]
+
+SUPPORTED_ENCODINGS = [
+    e for e in COMPRESSION_ENCODINGS
+    if e == "gzip" or (e == "zstd" and zstandard is not None)
+]
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data with the given content coding"""
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=COMPRESSION_GZIP_LEVEL)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress(data)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def decompress(data: bytes, encoding: Optional[str]) -> bytes:
+    """Decompress data encoded with the given content coding (None/identity passes through)"""
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return data
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "zstd" and zstandard is not None:
+        # Frames written by compress() carry their content size; the
+        # streaming reader also handles frames that do not
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            return reader.read()
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick our most preferred encoding that the Accept-Encoding header allows"""
+    if not COMPRESSION_ENABLED or not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in SUPPORTED_ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def accept_encoding_header() -> str:
+    """Accept-Encoding value advertising the encodings this process can decode"""
+    return ", ".join(SUPPORTED_ENCODINGS + ["identity"])
+
+
+def encode_body(payload: dict) -> Tuple[bytes, dict]:
+    """Serialize payload to JSON, compressing it when it is large enough"""
+    body = dumps(payload)
+    headers = {
+        "content-type": "application/json",
+        "accept-encoding": accept_encoding_header(),
+    }
+    if "request_id" in payload:
+        headers["x-request-id"] = str(payload["request_id"])
+    if payload.get("job_id") is not None:
+        headers["x-job-id"] = str(payload["job_id"])
+    key = document_key(payload.get("text"))
+    if key is not None:
+        headers[DOCUMENT_KEY_HEADER] = key
+    if COMPRESSION_ENABLED and SUPPORTED_ENCODINGS and len(body) >= COMPRESSION_MIN_SIZE:
+        encoding = SUPPORTED_ENCODINGS[0]
+        body = compress(body, encoding)
+        headers["content-encoding"] = encoding
+    return body, headers
+
+
+def decode_json(raw: bytes, content_encoding: Optional[str]) -> dict:
+    """Parse a raw (possibly compressed) JSON body"""
+    return loads(decompress(raw, content_encoding))
+
+
+async def post_json(client: httpx.AsyncClient, url: str, payload: dict, timeout: float) -> httpx.Response:
+    """
+    POST payload as JSON, compressed when large, advertising compressed
+    responses and carrying the request's deadline (or one timeout from now)
+    """
+    body, headers = encode_body(payload)
+    headers.update(deadline_headers(timeout))
+    return await client.post(url, content=body, headers=headers, timeout=timeout)
+
+
+def response_json(response: httpx.Response) -> dict:
+    """
+    Parse a JSON response body. httpx transparently decodes gzip but not
+    zstd, so zstd bodies are decoded here.
+    """
+    if response.headers.get("content-encoding", "").lower() == "zstd":
+        return loads(decompress(response.content, "zstd"))
+    return loads(response.content)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware that decompresses gzip/zstd request bodies and compresses
+    responses of at least COMPRESSION_MIN_SIZE bytes for callers that accept
+    it. Responses that already carry a Content-Encoding (e.g. bodies a load
+    balancer passes through untouched) are never re-compressed.
+    """
+
+    def __init__(self, app, decompress_requests: bool = True, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.decompress_requests = decompress_requests
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+
+        content_encoding = headers.get("content-encoding", "identity").lower()
+        if self.decompress_requests and content_encoding != "identity":
+            body = await self._read_body(receive)
+            try:
+                body = decompress(body, content_encoding)
+            except Exception as e:
+                logger.error(f"[Compression] Could not decode {content_encoding} request body: {str(e)}")
+                await self._send_error(send, 400, f"Invalid {content_encoding} request body")
+                return
+            scope = dict(scope)
+            scope["headers"] = [
+                (k, v) for k, v in scope["headers"] if k.lower() not in (b"content-encoding", b"content-length")
+            ] + [(b"content-length", str(len(body)).encode("latin-1"))]
+            receive = self._replay(body, receive)
+
+        encoding = choose_encoding(headers.get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        await self.app(scope, receive, self._compressing_send(send, encoding))
+
+    def _compressing_send(self, send, encoding):
+        start_message = None
+        chunks = []
+
+        async def wrapped_send(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                response_headers = {k.lower() for k, _ in message.get("headers", [])}
+                if b"content-encoding" in response_headers:
+                    start_message = False
+                    await send(message)
+                else:
+                    start_message = message
+                return
+
+            if message["type"] != "http.response.body" or start_message is False:
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            response_headers = [
+                (k, v) for k, v in start_message.get("headers", []) if k.lower() != b"content-length"
+            ]
+            if len(body) >= self.minimum_size:
+                body = compress(body, encoding)
+                response_headers.append((b"content-encoding", encoding.encode("latin-1")))
+            response_headers.append((b"vary", b"Accept-Encoding"))
+            response_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+            await send({**start_message, "headers": response_headers})
+            await send({"type": "http.response.body", "body": body})
+
+        return wrapped_send
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    @staticmethod
+    def _replay(body: bytes, receive):
+        sent = False
+
+        async def replay_receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return replay_receive
+
+    @staticmethod
+    async def _send_error(send, status_code: int, detail: str):
+        body = dumps({"detail": detail})
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode("latin-1"))],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,113 @@
+"""
+Absolute request deadlines propagated across hops.
+
+Every outgoing call carries an X-Request-Deadline header (seconds since the
+epoch). A caller that has no deadline yet starts one from its own timeout.
+DeadlineMiddleware rejects requests whose deadline already passed with 504
+and makes the deadline available to the handler, so downstream calls only
+get the time that is left (remaining_timeout) instead of a fresh per-hop
+timeout. Hosts are assumed to have synchronized clocks.
+"""
+
+import logging
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from common.fastjson import dumps
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_HEADER = "x-request-deadline"
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when there is no time left for a request's downstream work"""
+
+
+def current_deadline() -> Optional[float]:
+    """Absolute deadline of the request being handled, if it has one"""
+    return _deadline.get()
+
+
+def set_deadline(deadline: Optional[float]):
+    """Make deadline the current one, e.g. in a context created for work done on behalf of several requests"""
+    _deadline.set(deadline)
+
+
+def remaining_timeout(default: float) -> float:
+    """Timeout for a downstream call: the time left before the deadline, or default without one"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded by {-left:.3f}s")
+    return left
+
+
+def deadline_headers(timeout: float) -> dict:
+    """Deadline header for a downstream call, starting a deadline of timeout seconds if there is none"""
+    deadline = _deadline.get()
+    if deadline is None:
+        deadline = time.time() + timeout
+    return {DEADLINE_HEADER: f"{deadline:.3f}"}
+
+
+class DeadlineMiddleware:
+    """
+    ASGI middleware that rejects requests past their X-Request-Deadline with
+    504 and exposes the deadline to the handler (and any background work it
+    starts) through current_deadline() and remaining_timeout()
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        header = next((v for k, v in scope["headers"] if k.lower() == DEADLINE_HEADER.encode("latin-1")), None)
+        if header is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            deadline = float(header)
+        except ValueError:
+            await self._send_error(send, 400, f"Invalid {DEADLINE_HEADER} header")
+            return
+
+        left = deadline - time.time()
+        if left <= 0:
+            logger.warning(f"[Deadline] Rejecting {scope['path']}: deadline passed {-left:.3f}s ago")
+            await self._send_error(send, 504, f"Deadline exceeded by {-left:.3f}s")
+            return
+
+        token = _deadline.set(deadline)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _deadline.reset(token)
+
+    @staticmethod
+    async def _send_error(send, status_code: int, detail: str):
+        body = dumps({"detail": detail})
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode("latin-1"))],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def raise_for_status(response):
+    """response.raise_for_status(), raising DeadlineExceeded when downstream ran out of time (504)"""
+    if response.status_code == 504:
+        raise DeadlineExceeded(f"Deadline exceeded downstream of {response.request.url.host}")
+    response.raise_for_status()
@@ -0,0 +1,30 @@
+"""
+Fast JSON encoding for the internal hops: orjson when it is installed,
+standard library json otherwise. See common/responses.py for the response
+classes built on it.
+"""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, json is always available
+    orjson = None
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize obj to compact UTF-8 JSON"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    """Parse a JSON document from bytes or str"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
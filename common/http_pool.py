@@ -0,0 +1,112 @@
+"""
+Process-wide pooled HTTP client.
+
+Hops share one httpx.AsyncClient per process instead of opening a client
+(and new TCP connections) per request, so keep-alive connections opened
+by earlier requests, or by readiness warm-up, are reused.
+
+Co-located services can be reached over Unix domain sockets instead of
+TCP: a URL of the form unix:///path/to/service.sock/route (the socket file
+name must end in .sock) is sent to the socket at /path/to/service.sock,
+over its own pool of keep-alive connections. Such URLs can be used wherever
+a service URL or load balancer instance is configured, passed through
+service_url() (see common/launcher.py for the listening side).
+"""
+
+import os
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+# Configuration
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+# Below the servers' keep-alive timeout, so idle connections are closed
+# by this side rather than reset under a request
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60.0))
+
+UNIX_SCHEME = "unix"
+UNIX_SOCKET_SUFFIX = ".sock"
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def service_url(address: str) -> str:
+    """
+    Base URL of a service given as host:port or as a URL. unix:///path.sock
+    gets a placeholder host, as httpx treats URLs without one as relative.
+    """
+    if address.startswith(f"{UNIX_SCHEME}:///"):
+        return f"{UNIX_SCHEME}://localhost/{address[len(UNIX_SCHEME) + 4:]}"
+    return address if "://" in address else f"http://{address}"
+
+
+def split_unix_path(path: str) -> Tuple[str, str]:
+    """Split the path of a unix:// URL into the socket path and the route on that socket"""
+    index = path.find(UNIX_SOCKET_SUFFIX + "/")
+    if index < 0:
+        if not path.endswith(UNIX_SOCKET_SUFFIX):
+            raise httpx.UnsupportedProtocol(f"Unix socket path of {path} does not end in {UNIX_SOCKET_SUFFIX}")
+        return path, "/"
+    end = index + len(UNIX_SOCKET_SUFFIX)
+    return path[:end], path[end:]
+
+
+class UnixSocketTransport(httpx.AsyncBaseTransport):
+    """
+    Sends unix:// URLs to their socket, one keep-alive pool per socket, and
+    every other URL through a regular TCP pool
+    """
+
+    def __init__(self, limits: httpx.Limits):
+        self.limits = limits
+        self.tcp = httpx.AsyncHTTPTransport(limits=limits)
+        self.sockets: Dict[str, httpx.AsyncHTTPTransport] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.url.scheme != UNIX_SCHEME:
+            return await self.tcp.handle_async_request(request)
+
+        socket_path, route = split_unix_path(request.url.path)
+        transport = self.sockets.get(socket_path)
+        if transport is None:
+            transport = self.sockets[socket_path] = httpx.AsyncHTTPTransport(uds=socket_path, limits=self.limits)
+        headers = request.headers.copy()
+        headers.setdefault("host", "localhost")
+        return await transport.handle_async_request(httpx.Request(
+            request.method,
+            request.url.copy_with(scheme="http", host="localhost", path=route),
+            headers=headers,
+            stream=request.stream,
+            extensions=request.extensions
+        ))
+
+    async def aclose(self):
+        await self.tcp.aclose()
+        for transport in self.sockets.values():
+            await transport.aclose()
+
+
+def create_client(**kwargs) -> httpx.AsyncClient:
+    """A pooled client that also understands unix:// URLs"""
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+    return httpx.AsyncClient(transport=UnixSocketTransport(limits), **kwargs)
+
+
+def shared_client() -> httpx.AsyncClient:
+    """The process's pooled client, created on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    return _client
+
+
+async def close_shared_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
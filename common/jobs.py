@@ -0,0 +1,12 @@
+"""Tags that mark a request as one chunk of a multi-chunk job"""
+
+JOB_FIELDS = ("job_id", "chunk_index", "total_chunks")
+
+
+def job_fields(request) -> dict:
+    """The job tags set on a request model, for forwarding downstream"""
+    return {
+        field: getattr(request, field)
+        for field in JOB_FIELDS
+        if getattr(request, field, None) is not None
+    }
@@ -0,0 +1,167 @@
+"""
+Production server launcher shared by every service and load balancer.
+
+Runs uvicorn with uvloop and httptools when they are installed, one worker
+process per available CPU (cgroup quota and affinity aware), tuned backlog
+and keep-alive, and a graceful drain of in-flight requests on SIGTERM. With
+LAUNCHER_REUSEPORT each worker binds its own SO_REUSEPORT socket so the
+kernel balances connections across them instead of one shared accept queue.
+With SERVICE_SOCKET the service also listens on that Unix domain socket,
+shared by all workers, so co-located callers can skip the TCP stack (see
+common/http_pool.py for the connecting side).
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import stat
+from typing import Optional
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+HOST = os.getenv("HOST", "0.0.0.0")
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY")
+LAUNCHER_REUSEPORT = os.getenv("LAUNCHER_REUSEPORT", "true").lower() == "true"
+LAUNCHER_BACKLOG = int(os.getenv("LAUNCHER_BACKLOG", 4096))
+LAUNCHER_KEEP_ALIVE = int(os.getenv("LAUNCHER_KEEP_ALIVE", 75))
+LAUNCHER_GRACEFUL_TIMEOUT = int(os.getenv("LAUNCHER_GRACEFUL_TIMEOUT", 30))
+# Also listen on this Unix domain socket path (its file name must end in .sock)
+SERVICE_SOCKET = os.getenv("SERVICE_SOCKET")
+
+
+def _installed(module: str) -> bool:
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def available_cpus() -> int:
+    """CPUs this process may use, honouring CPU affinity and a cgroup v2 quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+
+def worker_count(stateful: bool = False) -> int:
+    """
+    Worker processes to run. Services that keep request state in memory
+    (pending callbacks, reducer jobs, round-robin position) default to one.
+    """
+    if WEB_CONCURRENCY:
+        return max(1, int(WEB_CONCURRENCY))
+    return 1 if stateful else available_cpus()
+
+
+def server_options(port: int) -> dict:
+    return {
+        "host": HOST,
+        "port": port,
+        "loop": "uvloop" if _installed("uvloop") else "asyncio",
+        "http": "httptools" if _installed("httptools") else "h11",
+        "backlog": LAUNCHER_BACKLOG,
+        "timeout_keep_alive": LAUNCHER_KEEP_ALIVE,
+        "timeout_graceful_shutdown": LAUNCHER_GRACEFUL_TIMEOUT,
+    }
+
+
+def _reuseport_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def unix_socket(path: str) -> socket.socket:
+    """Bind a Unix domain socket at path, replacing a stale socket left by an earlier run"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    # Callers run as other users in other containers sharing the socket's volume
+    os.chmod(path, 0o666)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _serve_sockets(app: str, options: dict, workers: int, sockets: list):
+    """Serve on already bound sockets, from worker processes sharing them when workers > 1"""
+    config = uvicorn.Config(app, workers=workers, **options)
+    server = uvicorn.Server(config)
+    if workers == 1:
+        server.run(sockets=sockets)
+    else:
+        Multiprocess(config, target=server.run, sockets=sockets).run()
+
+
+def _serve_reuseport(app: str, options: dict, shared_sockets: list):
+    """Worker process: serve on a private SO_REUSEPORT socket (and any shared ones) until SIGTERM"""
+    sock = _reuseport_socket(options["host"], options["port"])
+    config = uvicorn.Config(app, workers=1, **options)
+    uvicorn.Server(config).run(sockets=[sock, *shared_sockets])
+
+
+def _run_reuseport_workers(app: str, options: dict, workers: int, shared_sockets: list):
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_serve_reuseport, args=(app, options, shared_sockets), name=f"worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def drain(signum, frame):
+        # Each worker's uvicorn stops accepting, finishes in-flight
+        # requests (up to the graceful timeout) and exits
+        logger.info(f"[Launcher] Received signal {signum}, draining {workers} workers")
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+    for process in processes:
+        process.join()
+
+
+def run(app: str, port: int, name: str, stateful: bool = False, workers: Optional[int] = None):
+    """
+    Serve the ASGI app given as an import string (e.g. "app:app")
+    """
+    workers = workers or worker_count(stateful)
+    options = server_options(port)
+    logger.info(f"[{name}] Starting on port {port}{f' and {SERVICE_SOCKET}' if SERVICE_SOCKET else ''} "
+                f"with {workers} worker(s), loop={options['loop']}, http={options['http']}")
+    shared_sockets = [unix_socket(SERVICE_SOCKET)] if SERVICE_SOCKET else []
+
+    if LAUNCHER_REUSEPORT and hasattr(socket, "SO_REUSEPORT") and workers > 1:
+        _run_reuseport_workers(app, options, workers, shared_sockets)
+    elif shared_sockets:
+        tcp = uvicorn.Config(app, **options).bind_socket()
+        _serve_sockets(app, options, workers, [tcp, *shared_sockets])
+    else:
+        uvicorn.run(app, workers=workers, **options)
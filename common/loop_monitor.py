@@ -0,0 +1,179 @@
+"""
+Event-loop lag and slow-callback monitor.
+
+A task sleeps LOOP_LAG_INTERVAL at a time and records how much later than
+scheduled it wakes up: that delay is time the loop spent running other
+callbacks, and goes into a histogram. A watchdog thread notices when that
+wake-up is overdue, i.e. while one callback still holds the loop, and
+captures the loop thread's stack and the task it is running; if the delay
+ends up over LOOP_SLOW_THRESHOLD it is reported as a slow callback with
+that stack and the route and request id of the task. LoopMonitorMiddleware
+registers the task of every request, and tasks spawned while serving it
+(e.g. by single-flight) inherit its entry. Works with asyncio and uvloop
+alike, which does not let individual callbacks be timed.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "true").lower() == "true"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.05))
+LOOP_SLOW_THRESHOLD = float(os.getenv("LOOP_SLOW_THRESHOLD", 0.1))
+# Slow callbacks kept for /stats
+LOOP_SLOW_RECENT = int(os.getenv("LOOP_SLOW_RECENT", 50))
+
+# Upper bounds of the lag histogram buckets, in milliseconds
+LAG_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Innermost frames of the loop thread reported with a slow callback
+STACK_DEPTH = 8
+
+# Task serving (or spawned by) a request in flight -> (route, request_id)
+_task_requests: "weakref.WeakKeyDictionary[asyncio.Task, Tuple[str, str]]" = weakref.WeakKeyDictionary()
+
+
+class LoopMonitorMiddleware:
+    """ASGI middleware that makes the request running on the loop identifiable from its stack"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not LOOP_MONITOR or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = next((v for k, v in scope["headers"] if k.lower() == b"x-request-id"), b"-")
+        task = asyncio.current_task()
+        _task_requests[task] = (f"{scope['method']} {scope['path']}", request_id.decode("latin-1"))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _task_requests.pop(task, None)
+
+
+def _request_of(task: Optional[asyncio.Task]) -> Optional[Tuple[str, str]]:
+    return _task_requests.get(task) if task is not None else None
+
+
+def _task_factory(loop, coro, **kwargs):
+    """Create tasks as usual, tagged with the request of the task creating them"""
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    request = _request_of(asyncio.current_task(loop))
+    if request is not None:
+        _task_requests[task] = request
+    return task
+
+
+def _innermost_frames(frame) -> list:
+    stack = []
+    while frame is not None and len(stack) < STACK_DEPTH:
+        stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return stack
+
+
+class LoopMonitor:
+    def __init__(self, name: str):
+        self.name = name
+        self.buckets = [0] * (len(LAG_BUCKETS_MS) + 1)
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_callbacks = 0
+        self.recent_slow: deque = deque(maxlen=LOOP_SLOW_RECENT)
+        # When the lag task is due to wake up next (time.monotonic)
+        self._due = float("inf")
+        # Set by the watchdog while a callback holds the loop
+        self._stall: Optional[dict] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start monitoring the running loop (call from a startup handler)"""
+        if not LOOP_MONITOR or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        if self._loop.get_task_factory() is None:
+            self._loop.set_task_factory(_task_factory)
+        self._task = asyncio.create_task(self._measure_lag())
+        threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _measure_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + LOOP_LAG_INTERVAL
+            self._due = time.monotonic() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - scheduled)
+            self._due = float("inf")
+            self.record_lag(lag)
+            if lag >= LOOP_SLOW_THRESHOLD:
+                self.record_slow(lag, self._stall)
+            self._stall = None
+
+    def _watchdog(self):
+        # Checked often enough to catch a callback well before it becomes slow
+        while not self._stop.wait(LOOP_SLOW_THRESHOLD / 8):
+            due = self._due
+            if self._stall is not None or time.monotonic() - due < LOOP_SLOW_THRESHOLD / 2:
+                continue
+            stack = _innermost_frames(sys._current_frames().get(self._loop_thread))
+            request = _request_of(asyncio.current_task(self._loop))
+            # Dropped if the loop got going again meanwhile
+            if due == self._due:
+                self._stall = {"route": request[0] if request else None,
+                               "request_id": request[1] if request else None, "stack": stack}
+
+    def record_lag(self, lag: float):
+        lag_ms = lag * 1000
+        index = next((i for i, bound in enumerate(LAG_BUCKETS_MS) if lag_ms <= bound), len(LAG_BUCKETS_MS))
+        self.buckets[index] += 1
+        self.samples += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def record_slow(self, lag: float, stall: Optional[dict]):
+        stall = stall or {"route": None, "request_id": None, "stack": []}
+        self.slow_callbacks += 1
+        self.recent_slow.append({"at": round(time.time(), 3), "blocked_seconds": round(lag, 4), **stall})
+        where = f"{stall['route']} (request {stall['request_id']})" if stall["route"] else "outside any request"
+        logger.warning(f"[{self.name}] Event loop blocked for {lag:.3f}s by {where}"
+                       + (f" in {stall['stack'][0]}" if stall["stack"] else ""))
+
+    def stats(self) -> dict:
+        if not LOOP_MONITOR:
+            return {"enabled": False}
+        labels = [f"le_{bound}ms" for bound in LAG_BUCKETS_MS] + ["inf"]
+        return {
+            "enabled": True,
+            "lag": {
+                "samples": self.samples,
+                "mean_ms": round(self.total_lag / self.samples * 1000, 3) if self.samples else 0.0,
+                "max_ms": round(self.max_lag * 1000, 3),
+                "buckets": dict(zip(labels, self.buckets))
+            },
+            "slow_callbacks": {
+                "threshold_seconds": LOOP_SLOW_THRESHOLD,
+                "count": self.slow_callbacks,
+                "recent": list(self.recent_slow)
+            }
+        }
@@ -0,0 +1,157 @@
+"""
+Opt-in per-request memory accounting for the stage services.
+
+With MEMORY_PROFILING=true a sampled share (MEMORY_SAMPLE_RATE) of the
+requests run their stage function under tracemalloc, in whichever process
+the stage executor runs it. The peak of traced memory is recorded per
+request, and the largest allocation sites are taken from snapshots a
+background thread grabs while traced memory grows, so they show what was
+alive near the peak rather than what is left at the end. Only one call per
+process is traced at a time; tracing is process-wide, so work running
+concurrently on other threads counts towards a request's peak. Disabled,
+the cost is one flag check per request.
+"""
+
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "false").lower() == "true"
+MEMORY_SAMPLE_RATE = float(os.getenv("MEMORY_SAMPLE_RATE", 1.0))
+# Stack frames stored per traced allocation (more frames cost more memory)
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", 1))
+MEMORY_TOP_SITES = int(os.getenv("MEMORY_TOP_SITES", 5))
+# Recent measurements per stage the percentiles are computed over
+MEMORY_WINDOW = int(os.getenv("MEMORY_WINDOW", 1000))
+MEMORY_SNAPSHOT_INTERVAL = float(os.getenv("MEMORY_SNAPSHOT_INTERVAL", 0.05))
+
+# Traced memory must grow by this factor before another snapshot is taken
+SNAPSHOT_GROWTH = 1.25
+PERCENTILES = (50, 90, 99)
+
+_measure_lock = threading.Lock()
+
+
+class _PeakSampler(threading.Thread):
+    """Snapshots traced memory each time it grows by SNAPSHOT_GROWTH"""
+
+    def __init__(self):
+        super().__init__(name="memory-sampler", daemon=True)
+        self.done = threading.Event()
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        self.snapshot_bytes = 0
+
+    def take(self, current: int):
+        self.snapshot = tracemalloc.take_snapshot()
+        self.snapshot_bytes = current
+
+    def run(self):
+        while not self.done.wait(MEMORY_SNAPSHOT_INTERVAL):
+            current, _ = tracemalloc.get_traced_memory()
+            if current > self.snapshot_bytes * SNAPSHOT_GROWTH:
+                self.take(current)
+
+
+def measure_call(func: Callable, *args) -> tuple:
+    """
+    Run func(*args) under tracemalloc. Returns (result, report), where
+    report is None when another call in this process is already traced.
+    """
+    if not _measure_lock.acquire(blocking=False):
+        return func(*args), None
+    was_tracing = tracemalloc.is_tracing()
+    try:
+        if not was_tracing:
+            tracemalloc.start(MEMORY_TRACE_FRAMES)
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        sampler = _PeakSampler()
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            result = func(*args)
+        finally:
+            sampler.done.set()
+            sampler.join()
+        seconds = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        if sampler.snapshot is None or current > sampler.snapshot_bytes:
+            sampler.take(current)
+        # Leave out the sampler's own allocations
+        snapshot = sampler.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                   tracemalloc.Filter(False, threading.__file__)])
+        sites = [
+            {"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", "bytes": stat.size,
+             "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:MEMORY_TOP_SITES]
+        ]
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+        _measure_lock.release()
+    return result, {"peak_bytes": peak - baseline, "seconds": round(seconds, 4), "top_sites": sites}
+
+
+def _percentile(ordered: list, percent: int) -> int:
+    """Nearest-rank percentile of a sorted list"""
+    return ordered[max(0, -(-len(ordered) * percent // 100) - 1)]
+
+
+class MemoryProfiler:
+    def __init__(self, name: str):
+        self.name = name
+        self.enabled = MEMORY_PROFILING
+        self.reports: Dict[str, Deque[dict]] = defaultdict(lambda: deque(maxlen=MEMORY_WINDOW))
+        self.stats_counters = {"measured": 0, "skipped": 0}
+
+    async def run(self, request_id: str, stage: str, run: Optional[Callable[..., Awaitable]],
+                  func: Callable, *args):
+        """
+        func(*args), awaited through run(func, *args) (a stage executor) or
+        called inline when run is None, with its memory measured when the
+        request is sampled
+        """
+        if not self.enabled or random.random() >= MEMORY_SAMPLE_RATE:
+            return await run(func, *args) if run is not None else func(*args)
+
+        if run is not None:
+            result, report = await run(measure_call, func, *args)
+        else:
+            result, report = measure_call(func, *args)
+
+        if report is None:
+            self.stats_counters["skipped"] += 1
+        else:
+            self.record(request_id, stage, report)
+        return result
+
+    def record(self, request_id: str, stage: str, report: dict):
+        self.stats_counters["measured"] += 1
+        self.reports[stage].append({"request_id": request_id, **report})
+        top = report["top_sites"][0] if report["top_sites"] else None
+        logger.info(
+            f"[{self.name}] Memory of {stage} for {request_id}: peak {report['peak_bytes'] / 2**20:.1f} MiB "
+            f"in {report['seconds']}s" + (f", largest site {top['site']} ({top['bytes'] / 2**20:.1f} MiB)" if top else "")
+        )
+
+    def stats(self) -> dict:
+        stages = {}
+        for stage, reports in self.reports.items():
+            peaks = sorted(report["peak_bytes"] for report in reports)
+            stages[stage] = {
+                "requests": len(peaks),
+                **{f"p{percent}_peak_bytes": _percentile(peaks, percent) for percent in PERCENTILES},
+                "max_peak_bytes": peaks[-1],
+                "largest": heapq.nlargest(MEMORY_TOP_SITES, reports, key=lambda report: report["peak_bytes"])
+            }
+        return {"enabled": self.enabled, "sample_rate": MEMORY_SAMPLE_RATE, **self.stats_counters,
+                "stages": stages}
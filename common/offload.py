@@ -0,0 +1,101 @@
+"""
+Size-based offloading of CPU-bound stage work from the event loop.
+
+Inputs smaller than OFFLOAD_MIN_SIZE run inline (cheaper than a hop to a
+pool); larger ones run in a bounded thread or process pool so /health and
+other in-flight requests keep being served. At most OFFLOAD_WORKERS jobs
+are handed to the pool at a time, the rest wait on the event loop, and
+beyond OFFLOAD_MAX_QUEUE waiting jobs new work is rejected.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+OFFLOAD_EXECUTOR = os.getenv("OFFLOAD_EXECUTOR", "thread")  # "thread", "process" or "none"
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", 2))
+OFFLOAD_MIN_SIZE = int(os.getenv("OFFLOAD_MIN_SIZE", 64 * 1024))
+OFFLOAD_MAX_QUEUE = int(os.getenv("OFFLOAD_MAX_QUEUE", 64))
+
+
+class OffloadQueueFull(Exception):
+    """Raised when more than OFFLOAD_MAX_QUEUE jobs are already waiting"""
+
+
+class StageExecutor:
+    def __init__(self, name: str, mode: str = OFFLOAD_EXECUTOR, workers: int = OFFLOAD_WORKERS,
+                 min_size: int = OFFLOAD_MIN_SIZE, max_queue: int = OFFLOAD_MAX_QUEUE):
+        self.name = name
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.min_size = min_size
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.running = 0
+        self.stats_counters = {"inline": 0, "offloaded": 0, "rejected": 0, "max_waiting": 0}
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == "process":
+                # spawn, not fork: the parent runs an event loop and threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix=f"{self.name}-stage"
+                )
+            logger.info(f"[{self.name}] Started {self.mode} pool with {self.workers} workers")
+        return self._executor
+
+    async def run(self, size: int, func: Callable, *args):
+        """Run func(*args) inline when size is small, otherwise in the pool"""
+        if self.mode == "none" or size < self.min_size:
+            self.stats_counters["inline"] += 1
+            return func(*args)
+
+        if self.waiting >= self.max_queue:
+            self.stats_counters["rejected"] += 1
+            raise OffloadQueueFull(f"{self.name} executor queue is full ({self.waiting} waiting)")
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+
+        self.waiting += 1
+        self.stats_counters["max_waiting"] = max(self.stats_counters["max_waiting"], self.waiting)
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            self.stats_counters["offloaded"] += 1
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "min_size": self.min_size,
+            "max_queue": self.max_queue,
+            "queue_depth": self.waiting,
+            "running": self.running,
+            **self.stats_counters
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
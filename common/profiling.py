@@ -0,0 +1,164 @@
+"""
+On-demand profiling under live traffic.
+
+GET /debug/profile is only served when DEBUG_PROFILE_TOKEN is set, and only
+to callers sending it in the X-Debug-Token header. One session runs per
+process at a time (409 otherwise), for at most DEBUG_PROFILE_MAX_SECONDS.
+
+- mode=sample (default): a background thread samples the stacks of every
+  thread each interval for the given seconds, and the response is the
+  collapsed stacks ("thread;outer;...;inner count" lines) that flamegraph.pl
+  and speedscope read. The sampled threads are never paused or traced.
+- mode=request: cProfile the next request carrying the given X-Request-Id
+  (set on every hop by post_json) within the given seconds, and return its
+  pstats listing. cProfile traces the event loop thread, so any other
+  request interleaved with the tagged one is included, and stage work run
+  on offload threads or processes is not.
+"""
+
+import asyncio
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Empty disables the endpoint
+DEBUG_PROFILE_TOKEN = os.getenv("DEBUG_PROFILE_TOKEN", "")
+DEBUG_PROFILE_MAX_SECONDS = float(os.getenv("DEBUG_PROFILE_MAX_SECONDS", 60.0))
+DEBUG_PROFILE_MIN_INTERVAL = float(os.getenv("DEBUG_PROFILE_MIN_INTERVAL", 0.001))
+# Lines of the pstats listing returned in request mode
+DEBUG_PROFILE_STATS_LINES = int(os.getenv("DEBUG_PROFILE_STATS_LINES", 60))
+
+router = APIRouter()
+
+_session_lock = asyncio.Lock()
+
+
+class _RequestSession:
+    """A cProfile session armed for the next request with request_id"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.result: "asyncio.Future[str]" = asyncio.get_running_loop().create_future()
+
+
+# Armed request-mode session, claimed by the first matching request
+_armed: Optional[_RequestSession] = None
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """Sample the stack of every other thread each interval for seconds, counting collapsed stacks"""
+    own = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[";".join(reversed(stack))] += 1
+        del frame
+        time.sleep(interval)
+    return counts
+
+
+def _check_access(request: Request):
+    if not DEBUG_PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("x-debug-token", ""), DEBUG_PROFILE_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+
+@router.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10.0, mode: str = "sample",
+                        interval: float = 0.01, request_id: Optional[str] = None):
+    """Profile this process under live traffic, see common/profiling.py"""
+    global _armed
+    _check_access(request)
+    if not 0 < seconds <= DEBUG_PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {DEBUG_PROFILE_MAX_SECONDS}]")
+    if mode not in ("sample", "request"):
+        raise HTTPException(status_code=400, detail="mode must be sample or request")
+    if mode == "request" and not request_id:
+        raise HTTPException(status_code=400, detail="request mode needs a request_id")
+    if _session_lock.locked():
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+
+    name = request.app.title
+    async with _session_lock:
+        if mode == "sample":
+            interval = max(interval, DEBUG_PROFILE_MIN_INTERVAL)
+            logger.info(f"[{name}] Sampling stacks every {interval}s for {seconds}s")
+            counts = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, seconds, interval)
+            return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in counts.most_common()))
+
+        logger.info(f"[{name}] Waiting up to {seconds}s to profile request {request_id}")
+        _armed = _RequestSession(request_id)
+        try:
+            return PlainTextResponse(await asyncio.wait_for(asyncio.shield(_armed.result), seconds))
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=404, detail=f"No request {request_id} within {seconds}s")
+        finally:
+            _armed = None
+
+
+def _format_stats(profiler: cProfile.Profile, request_id: str, seconds: float) -> str:
+    out = io.StringIO()
+    out.write(f"request {request_id}: {seconds:.4f}s\n")
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(DEBUG_PROFILE_STATS_LINES)
+    return out.getvalue()
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that cProfiles the request an armed request-mode session is waiting for"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _armed
+        session = _armed
+        if session is None or scope["type"] != "http" or session.result.done():
+            await self.app(scope, receive, send)
+            return
+
+        request_id = next((v for k, v in scope["headers"] if k.lower() == b"x-request-id"), b"")
+        if request_id.decode("latin-1") != session.request_id:
+            await self.app(scope, receive, send)
+            return
+
+        # Claimed: later requests with the same id run unprofiled
+        _armed = None
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.disable()
+            if not session.result.done():
+                session.result.set_result(_format_stats(profiler, session.request_id, time.perf_counter() - started))
@@ -0,0 +1,121 @@
+"""
+Readiness gating, connection pre-warming and slow start.
+
+/health only says a process is up; /ready says it can do useful work. A
+ReadinessTracker polls the /ready endpoints of a process's downstream
+targets (the next load balancer for a service, the instances for a load
+balancer). When a target becomes ready, keep-alive connections to it are
+opened in the shared pool before it is reported ready, so the first real
+requests do not pay for connection setup. weight() ramps a newly ready
+target from SLOW_START_MIN_WEIGHT up to 1 over SLOW_START_SECONDS, so a
+load balancer eases traffic onto it instead of sending it a full share at once.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from common.http_pool import create_client, shared_client
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+READY_CHECK_INTERVAL = float(os.getenv("READY_CHECK_INTERVAL", 1.0))
+READY_CHECK_TIMEOUT = float(os.getenv("READY_CHECK_TIMEOUT", 2.0))
+WARM_CONNECTIONS = int(os.getenv("WARM_CONNECTIONS", 4))
+SLOW_START_SECONDS = float(os.getenv("SLOW_START_SECONDS", 10.0))
+SLOW_START_MIN_WEIGHT = float(os.getenv("SLOW_START_MIN_WEIGHT", 0.1))
+
+
+async def check_ready(client: httpx.AsyncClient, url: str) -> bool:
+    """Whether the service at base url answers its /ready endpoint with 200"""
+    try:
+        response = await client.get(f"{url}/ready", timeout=READY_CHECK_TIMEOUT)
+        return response.status_code == 200
+    except httpx.HTTPError:
+        return False
+
+
+async def warm_connections(client: httpx.AsyncClient, url: str, connections: int = WARM_CONNECTIONS) -> int:
+    """Open keep-alive connections to url with concurrent /health requests, returns how many succeeded"""
+    results = await asyncio.gather(
+        *[client.get(f"{url}/health", timeout=READY_CHECK_TIMEOUT) for _ in range(connections)],
+        return_exceptions=True
+    )
+    return sum(1 for result in results if isinstance(result, httpx.Response) and result.status_code == 200)
+
+
+async def wait_until_ready(url: str, timeout: float = 300.0, interval: float = 0.5) -> bool:
+    """Poll url's /ready endpoint until it reports ready, False if timeout passes first"""
+    deadline = time.monotonic() + timeout
+    async with create_client() as client:
+        while time.monotonic() < deadline:
+            if await check_ready(client, url):
+                return True
+            await asyncio.sleep(interval)
+    return False
+
+
+class ReadinessTracker:
+    def __init__(self, name: str, targets: Dict[str, str]):
+        """targets maps a name (an instance, a dependency) to its base URL"""
+        self.name = name
+        self.targets = targets
+        self.ready_since: Dict[str, Optional[float]] = {target: None for target in targets}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _check(self, target: str, url: str):
+        client = shared_client()
+        ready = await check_ready(client, url)
+        if ready and self.ready_since[target] is None:
+            warmed = await warm_connections(client, url)
+            self.ready_since[target] = time.monotonic()
+            logger.info(f"[{self.name}] {target} is ready ({warmed} connections warmed)")
+        elif not ready and self.ready_since[target] is not None:
+            self.ready_since[target] = None
+            logger.warning(f"[{self.name}] {target} is no longer ready")
+
+    async def poll_forever(self):
+        while True:
+            await asyncio.gather(*[self._check(target, url) for target, url in self.targets.items()])
+            await asyncio.sleep(READY_CHECK_INTERVAL)
+
+    def start(self):
+        """Start polling in the background (call from a startup handler)"""
+        if self.targets and self._task is None:
+            self._task = asyncio.create_task(self.poll_forever())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def is_ready(self, target: str) -> bool:
+        return self.ready_since[target] is not None
+
+    def all_ready(self) -> bool:
+        return all(since is not None for since in self.ready_since.values())
+
+    def any_ready(self) -> bool:
+        return any(since is not None for since in self.ready_since.values())
+
+    def weight(self, target: str, now: Optional[float] = None) -> float:
+        """Share of traffic target should get: 0 until ready, then ramping up to 1"""
+        since = self.ready_since[target]
+        if since is None:
+            return 0.0
+        if SLOW_START_SECONDS <= 0:
+            return 1.0
+        elapsed = (now if now is not None else time.monotonic()) - since
+        return min(1.0, max(SLOW_START_MIN_WEIGHT, elapsed / SLOW_START_SECONDS))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            target: {"ready": self.is_ready(target), "weight": round(self.weight(target, now), 2)}
+            for target in self.targets
+        }
@@ -0,0 +1,53 @@
+"""
+Response classes for the internal hops.
+
+FastJSONResponse renders with common.fastjson, trusted_response builds a
+stage's response from a downstream result without re-validating it through
+a pydantic model, and RawJSONResponse relays a downstream body byte for
+byte (still compressed) when no field changes.
+"""
+
+from typing import Any, Optional, Type
+
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+
+from common.fastjson import dumps
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with dumps()"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def trusted_response(model: Type[BaseModel], data: dict, **defaults) -> FastJSONResponse:
+    """
+    Response carrying the fields of model taken from a trusted internal
+    result, without validating or copying them through a model instance.
+    Missing fields take the given defaults, then the model's own defaults.
+    """
+    content = {}
+    for name, field in model.model_fields.items():
+        if name in data:
+            content[name] = data[name]
+        elif name in defaults:
+            content[name] = defaults[name]
+        elif not field.is_required():
+            content[name] = field.get_default(call_default_factory=True)
+        else:
+            raise ValueError(f"Missing field {name} for {model.__name__}")
+    return FastJSONResponse(content)
+
+
+class RawJSONResponse(Response):
+    """An already serialized, possibly compressed, JSON body relayed untouched"""
+
+    media_type = "application/json"
+
+    def __init__(self, raw: bytes, status_code: int = 200, content_encoding: Optional[str] = None):
+        headers = None
+        if content_encoding and content_encoding.lower() != "identity":
+            headers = {"content-encoding": content_encoding}
+        super().__init__(content=raw, status_code=status_code, headers=headers)
@@ -0,0 +1,185 @@
+"""
+Persistent result cache.
+
+Pipeline results are stored in a local SQLite database keyed by content
+hash, so a restarted (or redeployed, with the file on a volume) service
+answers documents it has already seen without running the pipeline again.
+Values are zlib-compressed JSON with a CRC32 checksum that is checked on
+every read; a corrupt entry is dropped and counts as a miss. The database
+runs in WAL mode, so a crash mid-write loses at most that write, and several
+worker processes can share one file. Least recently used entries are evicted
+once the stored values exceed RESULT_CACHE_MAX_BYTES. All SQLite calls run
+on one background thread so lookups never block the event loop, and cache
+errors only ever turn into misses.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from common.fastjson import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Empty disables the cache; point it at a volume for results to survive redeploys
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Larger (compressed) results are not cached
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", 1024 * 1024))
+# Change when the pipeline's output changes, so older results are never served
+RESULT_CACHE_VERSION = os.getenv("RESULT_CACHE_VERSION", "1")
+# Share of RESULT_CACHE_MAX_BYTES to evict down to
+EVICT_TO = 0.9
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    checksum INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed);
+-- Total size of the stored values, kept up to date for every process sharing the file
+CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+INSERT OR IGNORE INTO usage (id, bytes) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results
+BEGIN UPDATE usage SET bytes = bytes + NEW.size; END;
+CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF size ON results
+BEGIN UPDATE usage SET bytes = bytes + NEW.size - OLD.size; END;
+CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results
+BEGIN UPDATE usage SET bytes = bytes - OLD.size; END;
+"""
+
+
+class ResultCache:
+    def __init__(self, name: str, path: str = RESULT_CACHE_PATH, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.name = name
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = bool(path)
+        # One thread owns the connection, which also serializes its use
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache") if path else None
+        self._db: Optional[sqlite3.Connection] = None
+        self._total_bytes = 0
+        self.stats_counters = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0, "corrupt": 0, "errors": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._total_bytes = self._usage(db)
+            self._db = db
+            logger.info(f"[{self.name}] Result cache at {self.path} ({self._total_bytes} bytes stored)")
+        return self._db
+
+    @staticmethod
+    def _usage(db: sqlite3.Connection) -> int:
+        return db.execute("SELECT bytes FROM usage").fetchone()[0]
+
+    def _get(self, key: str) -> Optional[dict]:
+        db = self._connect()
+        row = db.execute("SELECT value, checksum FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, checksum = row
+        try:
+            if zlib.crc32(value) != checksum:
+                raise ValueError("checksum mismatch")
+            result = loads(zlib.decompress(value))
+        except (ValueError, zlib.error) as e:
+            logger.warning(f"[{self.name}] Dropping corrupt cache entry {key[:12]}: {str(e)}")
+            self.stats_counters["corrupt"] += 1
+            db.execute("DELETE FROM results WHERE key = ?", (key,))
+            return None
+        db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        return result
+
+    def _put(self, key: str, value: bytes):
+        db = self._connect()
+        db.execute(
+            "INSERT INTO results (key, value, checksum, size, accessed) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, checksum = excluded.checksum, "
+            "size = excluded.size, accessed = excluded.accessed",
+            (key, value, zlib.crc32(value), len(value), time.time())
+        )
+        self._total_bytes = self._usage(db)
+        if self._total_bytes > self.max_bytes:
+            self._evict(db)
+
+    def _evict(self, db: sqlite3.Connection):
+        """Delete least recently used entries until the cache is EVICT_TO full"""
+        total = self._total_bytes
+        target = int(self.max_bytes * EVICT_TO)
+        evicted = 0
+        while total > target:
+            rows = db.execute("SELECT key, size FROM results ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                break
+            db.execute("BEGIN IMMEDIATE")
+            for key, size in rows:
+                db.execute("DELETE FROM results WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+                if total <= target:
+                    break
+            db.execute("COMMIT")
+        self._total_bytes = total
+        self.stats_counters["evicted"] += evicted
+        logger.info(f"[{self.name}] Evicted {evicted} cached results ({total} bytes left)")
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, key: str) -> Optional[dict]:
+        """Cached result for key, None on a miss (or when the cache is disabled or failing)"""
+        if not self.enabled:
+            return None
+        try:
+            result = await self._call(self._get, key)
+        except sqlite3.Error as e:
+            logger.warning(f"[{self.name}] Result cache read failed: {str(e)}")
+            self.stats_counters["errors"] += 1
+            result = None
+        self.stats_counters["hits" if result is not None else "misses"] += 1
+        return result
+
+    async def put(self, key: str, result: dict):
+        """Store result for key, unless it is too large"""
+        if not self.enabled:
+            return
+        value = zlib.compress(dumps(result))
+        if len(value) > RESULT_CACHE_MAX_ENTRY_BYTES:
+            return
+        try:
+            await self._call(self._put, key, value)
+            self.stats_counters["writes"] += 1
+        except sqlite3.Error as e:
+            logger.warning(f"[{self.name}] Result cache write failed: {str(e)}")
+            self.stats_counters["errors"] += 1
+
+    def close(self):
+        if self._executor is not None:
+            if self._db is not None:
+                self._executor.submit(self._db.close).result()
+                self._db = None
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self.enabled = False
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        return {"enabled": True, "path": self.path, "bytes": self._total_bytes, "max_bytes": self.max_bytes,
+                **self.stats_counters}
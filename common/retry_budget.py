@@ -0,0 +1,52 @@
+"""
+Token-bucket retry budget for the load balancers.
+
+Every routed request deposits RETRY_BUDGET_RATIO tokens, the bucket also
+refills at RETRY_BUDGET_MIN_PER_SECOND so a quiet balancer can still retry,
+and every retry withdraws one token. Retries are therefore capped at a
+fraction of the traffic and cannot multiply the load on instances that are
+already failing because they are overloaded.
+"""
+
+import os
+import time
+
+# Configuration
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", 1.0))
+RETRY_BUDGET_CAPACITY = float(os.getenv("RETRY_BUDGET_CAPACITY", 10.0))
+
+
+class RetryBudget:
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, min_per_second: float = RETRY_BUDGET_MIN_PER_SECOND,
+                 capacity: float = RETRY_BUDGET_CAPACITY):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.stats_counters = {"requests": 0, "retries": 0, "denied": 0}
+
+    def _refill(self, amount: float = 0.0):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.min_per_second + amount)
+        self.updated = now
+
+    def deposit(self):
+        """Record a routed request"""
+        self.stats_counters["requests"] += 1
+        self._refill(self.ratio)
+
+    def try_withdraw(self) -> bool:
+        """Take the token for one retry, False when the budget is spent"""
+        self._refill()
+        if self.tokens < 1.0:
+            self.stats_counters["denied"] += 1
+            return False
+        self.tokens -= 1.0
+        self.stats_counters["retries"] += 1
+        return True
+
+    def stats(self) -> dict:
+        self._refill()
+        return {"tokens": round(self.tokens, 2), "capacity": self.capacity, **self.stats_counters}
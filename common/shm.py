@@ -0,0 +1,239 @@
+"""
+Shared-memory handoff of large payloads between co-located stages.
+
+With SHM_HANDOFF=true a stage writes a payload of at least SHM_MIN_BYTES
+once into a segment, a file in SHM_DIR (a tmpfs, /dev/shm by default), and
+sends downstream only a handle: {"segment", "offset", "length",
+"namespace"}. The receiver maps the segment and reads the payload through
+a read-only memoryview instead of parsing it out of a JSON body.
+
+References are counted by the filesystem. Every handle is a hard link to
+the segment, owned by its receiver, which unlinks it when done; the writer
+unlinks the segment's own name once it is done sending. The kernel frees
+the memory when the last link is gone and the last mapping is closed, so a
+late or repeated release is harmless. Links whose receiver never came (a
+lost request) are swept once older than SHM_MAX_AGE.
+
+Stages on other hosts, or in containers that do not share SHM_DIR, cannot
+see a segment, and the handle's namespace tells them so. A receiver that
+cannot attach a handle answers 421; the load balancers relay it instead of
+retrying, and the sender resends the payload inline and stops handing off
+to that destination for SHM_RETRY_SECONDS.
+"""
+
+import logging
+import mmap
+import os
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+import httpx
+
+from common.compression import post_json
+from common.deadline import remaining_timeout
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+SHM_HANDOFF = os.getenv("SHM_HANDOFF", "false").lower() == "true"
+SHM_MIN_BYTES = int(os.getenv("SHM_MIN_BYTES", 8 * 1024 * 1024))
+SHM_DIR = os.getenv("SHM_DIR", "/dev/shm")
+SHM_MAX_AGE = float(os.getenv("SHM_MAX_AGE", 600.0))
+SHM_RETRY_SECONDS = float(os.getenv("SHM_RETRY_SECONDS", 60.0))
+
+SEGMENT_PREFIX = "rest-payload-"
+# Answered by a receiver that cannot attach a handle
+HANDOFF_UNAVAILABLE_STATUS = 421
+
+
+class SharedPayloadUnavailable(Exception):
+    """Raised when the segment of a handle cannot be attached from this process"""
+
+
+def _namespace() -> str:
+    """Identifies SHM_DIR: the same for processes sharing it, different across hosts and private mounts"""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            boot_id = f.read().strip()
+        stat = os.stat(SHM_DIR)
+    except OSError:
+        return ""
+    return f"{boot_id}:{stat.st_dev}:{stat.st_ino}"
+
+
+NAMESPACE = _namespace()
+
+
+class Segment:
+    """A payload written to shared memory, referenced by its writer until closed"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+    def handle(self, offset: int = 0, length: Optional[int] = None) -> dict:
+        """A handle to the payload (or length bytes of it from offset), holding its own reference"""
+        link = f"{self.path}.{uuid.uuid4().hex[:12]}"
+        os.link(self.path, link)
+        return {
+            "segment": os.path.basename(link),
+            "offset": offset,
+            "length": self.size - offset if length is None else length,
+            "namespace": NAMESPACE,
+        }
+
+    def read(self) -> bytes:
+        """A copy of the payload, for sending it inline after all"""
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self) -> "Segment":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AttachedPayload:
+    """The payload of a handle, mapped read-only; view is valid until close()"""
+
+    def __init__(self, path: str, offset: int, length: int):
+        self.path = path
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            raise SharedPayloadUnavailable(f"Shared memory segment {os.path.basename(path)} not found")
+        try:
+            size = os.fstat(fd).st_size
+            if offset < 0 or length < 0 or offset + length > size:
+                raise ValueError(f"Handle [{offset}, {offset + length}) outside of a {size} byte segment")
+            self._map = mmap.mmap(fd, size, access=mmap.ACCESS_READ) if size else None
+        finally:
+            os.close(fd)
+        self.view = memoryview(self._map)[offset:offset + length] if self._map is not None else memoryview(b"")
+
+    def close(self):
+        """Drop the mapping (once nothing uses the view any more) and the handle's reference"""
+        self.view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Still exported (e.g. a numpy array over the view), unmapped when collected
+                pass
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SharedPayloads:
+    def __init__(self, name: str):
+        self.name = name
+        self.enabled = SHM_HANDOFF and bool(NAMESPACE)
+        # Destination URL -> monotonic time until which it gets inline payloads
+        self.unavailable_until: Dict[str, float] = {}
+        self._last_sweep = 0.0
+        self.stats_counters = {"segments": 0, "bytes_written": 0, "handed_off": 0, "fallbacks": 0,
+                               "attached": 0, "bytes_attached": 0, "rejected": 0, "swept": 0}
+        if SHM_HANDOFF and not NAMESPACE:
+            logger.warning(f"[{self.name}] {SHM_DIR} is not usable, sending payloads inline")
+
+    def use_for(self, url: str, size: int) -> bool:
+        """Whether a payload of size bytes for url should be handed off through shared memory"""
+        return (self.enabled and size >= SHM_MIN_BYTES
+                and self.unavailable_until.get(url, 0.0) <= time.monotonic())
+
+    def create(self, data) -> Segment:
+        """Write data (bytes or any buffer) into a new segment"""
+        self._sweep()
+        path = os.path.join(SHM_DIR, f"{SEGMENT_PREFIX}{uuid.uuid4().hex}")
+        with open(path, "xb") as f:
+            size = f.write(data)
+        self.stats_counters["segments"] += 1
+        self.stats_counters["bytes_written"] += size
+        return Segment(path, size)
+
+    def attach(self, handle: dict) -> AttachedPayload:
+        """Map the payload of a handle received from upstream"""
+        segment = os.path.basename(str(handle.get("segment", "")))
+        if not self.enabled or handle.get("namespace") != NAMESPACE or not segment.startswith(SEGMENT_PREFIX):
+            self.stats_counters["rejected"] += 1
+            raise SharedPayloadUnavailable(f"Shared memory segment {segment} is not visible from {self.name}")
+        try:
+            payload = AttachedPayload(os.path.join(SHM_DIR, segment), int(handle["offset"]), int(handle["length"]))
+        except SharedPayloadUnavailable:
+            self.stats_counters["rejected"] += 1
+            raise
+        self.stats_counters["attached"] += 1
+        self.stats_counters["bytes_attached"] += len(payload.view)
+        return payload
+
+    def release(self, handle: dict):
+        """Drop the reference held by a handle that was not delivered"""
+        try:
+            os.unlink(os.path.join(SHM_DIR, os.path.basename(handle["segment"])))
+        except FileNotFoundError:
+            pass
+
+    async def post_json(self, client: httpx.AsyncClient, url: str, build: Callable[[Optional[dict]], dict],
+                        segment: Optional[Segment], offset: int = 0, length: Optional[int] = None,
+                        timeout: float = 60.0) -> httpx.Response:
+        """
+        POST build(handle), handing off segment's payload (or length bytes of
+        it from offset), or build(None) with the payload inline when there is
+        no segment or the destination cannot attach it
+        """
+        if segment is not None and self.unavailable_until.get(url, 0.0) <= time.monotonic():
+            handle = segment.handle(offset, length)
+            try:
+                response = await post_json(client, url, build(handle), timeout=remaining_timeout(timeout))
+            except BaseException:
+                self.release(handle)
+                raise
+            if response.status_code != HANDOFF_UNAVAILABLE_STATUS:
+                self.stats_counters["handed_off"] += 1
+                return response
+
+            self.release(handle)
+            self.unavailable_until[url] = time.monotonic() + SHM_RETRY_SECONDS
+            self.stats_counters["fallbacks"] += 1
+            logger.warning(f"[{self.name}] {url} cannot attach shared memory, sending payloads inline "
+                           f"for {SHM_RETRY_SECONDS:.0f}s")
+        return await post_json(client, url, build(None), timeout=remaining_timeout(timeout))
+
+    def _sweep(self):
+        """Remove links older than SHM_MAX_AGE, at most every tenth of it"""
+        now = time.time()
+        if now - self._last_sweep < SHM_MAX_AGE / 10:
+            return
+        self._last_sweep = now
+        try:
+            with os.scandir(SHM_DIR) as entries:
+                for entry in entries:
+                    if not entry.name.startswith(SEGMENT_PREFIX):
+                        continue
+                    try:
+                        if now - entry.stat(follow_symlinks=False).st_mtime > SHM_MAX_AGE:
+                            os.unlink(entry.path)
+                            self.stats_counters["swept"] += 1
+                    except FileNotFoundError:
+                        pass
+        except OSError as e:
+            logger.warning(f"[{self.name}] Could not sweep {SHM_DIR}: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "min_bytes": SHM_MIN_BYTES,
+            "inline_destinations": [url for url, until in self.unavailable_until.items()
+                                    if until > time.monotonic()],
+            **self.stats_counters
+        }
@@ -0,0 +1,85 @@
+"""
+Single-flight request coalescing.
+
+Concurrent calls with the same key share one in-flight task and all receive
+its result (or its exception). The task runs independently of any single
+caller: it is shielded from a caller's cancellation and only cancelled once
+the last caller waiting for it goes away. Finished calls are forgotten, so
+this deduplicates in-flight work and never serves a cached result.
+"""
+
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+from common.fastjson import dumps
+
+logger = logging.getLogger(__name__)
+
+# Request fields that never change the result
+IGNORED_FIELDS = ("request_id",)
+
+
+def content_key(payload: dict, *extra: Optional[str]) -> str:
+    """SHA-256 over a request's fields (except its request_id) and any extra strings"""
+    digest = hashlib.sha256()
+    for name in sorted(payload):
+        if name in IGNORED_FIELDS:
+            continue
+        value = payload[name]
+        digest.update(name.encode("utf-8") + b"\0")
+        digest.update(value.encode("utf-8") if isinstance(value, str) else dumps(value))
+        digest.update(b"\0")
+    for value in extra:
+        digest.update((value or "").encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: Dict[str, _Call] = {}
+        self.stats_counters = {"calls": 0, "coalesced": 0, "cancelled": 0}
+
+    async def run(self, key: str, func: Callable[[], Awaitable]):
+        """Await func(), or the in-flight call already running for key"""
+        call = self.calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(func()))
+            call.task.add_done_callback(lambda task: self._forget(key, call))
+            self.calls[key] = call
+            self.stats_counters["calls"] += 1
+        else:
+            self.stats_counters["coalesced"] += 1
+            logger.info(f"[{self.name}] Coalesced request onto in-flight call {key[:12]} "
+                        f"({call.waiters + 1} waiting)")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Every caller went away, nobody needs the result any more
+                logger.info(f"[{self.name}] Cancelling in-flight call {key[:12]}, no callers left")
+                self.stats_counters["cancelled"] += 1
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key: str, call: _Call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self.calls),
+            "waiting": sum(call.waiters for call in self.calls.values()),
+            **self.stats_counters
+        }
@@ -0,0 +1,143 @@
+"""
+Size-class routing for the load balancers.
+
+Requests are classified by the size of their body on the wire against the
+SIZE_CLASSES thresholds, so one huge document does not sit in front of
+every small request that round-robin sends to the same instance. Each class
+can get a dedicated subset of the instances (SIZE_CLASS_INSTANCES, taken
+from the end of the instance list, the other classes share the rest)
+and/or a bounded number of requests in flight with a bounded queue behind
+it (SIZE_CLASS_CONCURRENCY, SIZE_CLASS_QUEUE_LIMIT). Every class keeps its
+own stats.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from common.deadline import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_classes(value: str) -> Dict[str, int]:
+    """Parse "name:number,name:number" into {name: number}"""
+    parsed = {}
+    for item in value.split(","):
+        if item.strip():
+            name, _, number = item.partition(":")
+            parsed[name.strip()] = int(number)
+    return parsed
+
+
+# Configuration
+SIZE_ROUTING = os.getenv("SIZE_ROUTING", "true").lower() == "true"
+# Smallest body size (bytes) of each class
+SIZE_CLASSES = _parse_classes(os.getenv("SIZE_CLASSES", "small:0,large:1048576"))
+# Instances reserved for a class
+SIZE_CLASS_INSTANCES = _parse_classes(os.getenv("SIZE_CLASS_INSTANCES", "large:1"))
+# Requests of a class in flight at once, and how many may wait behind them
+SIZE_CLASS_CONCURRENCY = _parse_classes(os.getenv("SIZE_CLASS_CONCURRENCY", "large:2"))
+SIZE_CLASS_QUEUE_LIMIT = int(os.getenv("SIZE_CLASS_QUEUE_LIMIT", 64))
+
+
+class SizeClassQueueFull(Exception):
+    """Raised when a size class already has SIZE_CLASS_QUEUE_LIMIT requests waiting"""
+
+
+class SizeClassRouter:
+    def __init__(self, name: str, instances: List[str]):
+        self.name = name
+        # Classes ordered by threshold, smallest first
+        self.classes = sorted(SIZE_CLASSES, key=SIZE_CLASSES.get) if SIZE_ROUTING else []
+        self.instances = self._assign_instances(instances)
+        self.limits = {size_class: SIZE_CLASS_CONCURRENCY[size_class]
+                       for size_class in self.classes if SIZE_CLASS_CONCURRENCY.get(size_class)}
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        self.class_stats = {
+            size_class: {"requests": 0, "errors": 0, "rejected": 0, "in_flight": 0, "waiting": 0,
+                         "total_seconds": 0.0}
+            for size_class in self.classes
+        }
+
+    def _assign_instances(self, instances: List[str]) -> Dict[str, List[str]]:
+        """Dedicated instances come off the end of the list, largest class first"""
+        assigned = {}
+        shared = list(instances)
+        for size_class in reversed(self.classes):
+            count = SIZE_CLASS_INSTANCES.get(size_class, 0)
+            if count and len(shared) > count:
+                assigned[size_class] = shared[-count:]
+                shared = shared[:-count]
+            elif count:
+                logger.warning(f"[{self.name}] Not enough instances to dedicate {count} to {size_class}, sharing")
+        for size_class in self.classes:
+            assigned.setdefault(size_class, shared)
+            logger.info(f"[{self.name}] Size class {size_class} (>= {SIZE_CLASSES[size_class]} bytes): "
+                        f"{', '.join(assigned[size_class])}")
+        return assigned
+
+    def classify(self, size: int) -> Optional[str]:
+        """Size class of a body of size bytes, None when size routing is off"""
+        size_class = None
+        for name in self.classes:
+            if size >= SIZE_CLASSES[name]:
+                size_class = name
+        return size_class
+
+    @asynccontextmanager
+    async def admit(self, size_class: Optional[str], timeout: float):
+        """
+        Hold one of the class's in-flight slots for the duration of the
+        block, and record its stats. Waits in the class's bounded queue for
+        at most timeout seconds, then raises DeadlineExceeded.
+        """
+        if size_class is None:
+            yield
+            return
+
+        stats = self.class_stats[size_class]
+        limit = self.limits.get(size_class)
+        slots = None
+        if limit:
+            if stats["waiting"] >= SIZE_CLASS_QUEUE_LIMIT:
+                stats["rejected"] += 1
+                raise SizeClassQueueFull(f"Queue for {size_class} requests is full ({stats['waiting']} waiting)")
+            slots = self._slots.setdefault(size_class, asyncio.Semaphore(limit))
+            stats["waiting"] += 1
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                stats["rejected"] += 1
+                raise DeadlineExceeded(f"Deadline exceeded waiting for a {size_class} slot")
+            finally:
+                stats["waiting"] -= 1
+
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            stats["errors"] += 1
+            raise
+        finally:
+            stats["in_flight"] -= 1
+            stats["total_seconds"] += time.perf_counter() - started
+            if slots is not None:
+                slots.release()
+
+    def stats(self) -> dict:
+        return {
+            size_class: {
+                "min_bytes": SIZE_CLASSES[size_class],
+                "instances": self.instances[size_class],
+                "concurrency": self.limits.get(size_class),
+                **{k: v for k, v in stats.items() if k != "total_seconds"},
+                "avg_seconds": round(stats["total_seconds"] / stats["requests"], 4) if stats["requests"] else 0.0
+            }
+            for size_class, stats in self.class_stats.items()
+        }
@@ -0,0 +1,74 @@
+"""
+Dictionary-encoded token arrays.
+
+A token stream is sent as its vocabulary (each distinct word once, in order
+of first occurrence) plus a packed array of token ids, base64 encoded. The
+id width is the smallest unsigned array typecode that fits the vocabulary.
+The packed ids can also travel separately as raw bytes (pack_tokens), e.g.
+through shared memory (see common/shm.py), and be decoded without a copy.
+"""
+
+import base64
+import sys
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+# Unsigned typecodes from narrowest to widest
+TYPECODES = ("B", "H", "I", "L", "Q")
+
+
+def _typecode_for(vocabulary_size: int) -> str:
+    for typecode in TYPECODES:
+        if vocabulary_size <= 1 << (8 * array(typecode).itemsize):
+            return typecode
+    raise ValueError(f"Vocabulary too large: {vocabulary_size}")
+
+
+def pack_tokens(words: Iterable[str]) -> Tuple[dict, bytes]:
+    """Encode a token stream as ({"vocabulary", "typecode", "itemsize"}, packed little-endian ids)"""
+    vocabulary = {}
+    ids = array("I", (vocabulary.setdefault(word, len(vocabulary)) for word in words))
+
+    typecode = _typecode_for(len(vocabulary))
+    if typecode != ids.typecode:
+        ids = array(typecode, ids)
+    if sys.byteorder != "little":
+        ids.byteswap()
+
+    return {"vocabulary": list(vocabulary), "typecode": typecode, "itemsize": ids.itemsize}, ids.tobytes()
+
+
+def encode_ids(packed: bytes) -> str:
+    """The "ids" field of an encode_tokens() payload for packed ids"""
+    return base64.b64encode(packed).decode("ascii")
+
+
+def encode_tokens(words: Iterable[str]) -> dict:
+    """Encode a token stream as {"vocabulary", "ids", "typecode", "itemsize"}"""
+    tokens, packed = pack_tokens(words)
+    return {**tokens, "ids": encode_ids(packed)}
+
+
+def decode_tokens(tokens: dict, packed: Optional[memoryview] = None) -> Tuple[List[str], array]:
+    """
+    Decode an encode_tokens() payload into (vocabulary, token ids), taking
+    the ids from packed instead of the payload when given. On little-endian
+    hosts those are a zero-copy memoryview of packed rather than an array.
+    """
+    itemsize = int(tokens["itemsize"])
+    typecode = next((t for t in TYPECODES if array(t).itemsize == itemsize), None)
+    if typecode is None:
+        raise ValueError(f"Unsupported token id width: {itemsize}")
+
+    if packed is not None and sys.byteorder == "little":
+        ids = memoryview(packed).cast("B").cast(typecode)
+    else:
+        ids = array(typecode)
+        ids.frombytes(packed if packed is not None else base64.b64decode(tokens["ids"]))
+        if sys.byteorder != "little":
+            ids.byteswap()
+
+    vocabulary = tokens["vocabulary"]
+    if ids and max(ids) >= len(vocabulary):
+        raise ValueError("Token id outside of vocabulary")
+    return vocabulary, ids
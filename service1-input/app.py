@@ -1,23 +1,70 @@
 import os
+import sys
 import logging
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Callable, Dict, Optional
+from contextlib import nullcontext
+import math
+import uuid
+import socket
 import httpx
 import asyncio
+from functools import partial
+
+# Shared helpers live next to app.py in the containers and at the repository
+# root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.chunking import split_text
+from common.compression import CompressionMiddleware, response_json
+from common.deadline import (DeadlineExceeded, DeadlineMiddleware, deadline_headers, raise_for_status,
+                             remaining_timeout)
+from common.http_pool import close_shared_client, service_url, shared_client
+from common.jobs import job_fields
+from common.loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from common.profiling import ProfilingMiddleware, router as profiling_router
+from common.readiness import ReadinessTracker
+from common.responses import FastJSONResponse, trusted_response
+from common.result_cache import RESULT_CACHE_VERSION, ResultCache
+from common.shm import Segment, SharedPayloads
+from common.singleflight import SingleFlight, content_key
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Service 1 - Text Input")
+app = FastAPI(title="Service 1 - Text Input", default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoopMonitorMiddleware)
+app.include_router(profiling_router)
 
 # Configuration
-SERVICE2_URL = os.getenv("SERVICE2_URL", "http://service2-loadbalancer:8062")
+SERVICE2_URL = service_url(os.getenv("SERVICE2_URL", "http://service2-loadbalancer:8062"))
+SERVICE4_URL = service_url(os.getenv("SERVICE4_URL", "http://service4-loadbalancer:8064"))
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8051))
+# Documents of at least SCATTER_THRESHOLD characters are cut into word-aligned
+# chunks of about SCATTER_CHUNK_SIZE bytes that run through the pipeline
+# concurrently; service4 merges their analyses. 0 disables scatter-gather.
+SCATTER_THRESHOLD = int(os.getenv("SCATTER_THRESHOLD", 4 * 1024 * 1024))
+SCATTER_CHUNK_SIZE = int(os.getenv("SCATTER_CHUNK_SIZE", 1024 * 1024))
+SCATTER_MAX_CHUNKS = int(os.getenv("SCATTER_MAX_CHUNKS", 16))
+# "chain" waits for the result to unwind back through every hop, "direct"
+# has service4 post it to CALLBACK_URL while intermediate hops return early
+COMPLETION_MODE = os.getenv("COMPLETION_MODE", "chain")
+CALLBACK_URL = service_url(os.getenv("CALLBACK_URL", f"http://{socket.gethostname()}:{SERVICE_PORT}"))
+COMPLETION_TIMEOUT = float(os.getenv("COMPLETION_TIMEOUT", 60.0))
+# Concurrent requests for the same document share one pipeline run
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "true").lower() == "true"
 
 class TextRequest(BaseModel):
     text: str
     request_id: str
+    # Set when the request is one chunk of a multi-chunk job
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+    total_chunks: Optional[int] = None
 
 class TextResponse(BaseModel):
     status: str
@@ -26,11 +73,171 @@ class TextResponse(BaseModel):
     report: str = ""
     top_words: list = []
 
+# Direct-return mode: requests waiting for their completion callback
+pending_completions: Dict[str, asyncio.Future] = {}
+
+single_flight = SingleFlight("Service 1")
+
+# Results of documents seen before, kept across restarts (RESULT_CACHE_PATH)
+result_cache = ResultCache("Service 1")
+
+# Large documents reach Service 2 through shared memory (SHM_HANDOFF), see common/shm.py
+shared_payloads = SharedPayloads("Service 1")
+
+# Downstream services that must be ready (and pre-connected) before this one is
+readiness = ReadinessTracker("Service 1", {"service2": SERVICE2_URL, "service4": SERVICE4_URL})
+loop_monitor = LoopMonitor("Service 1")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "service1"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: ready once Services 2 and 4 answer /ready and connections to them are warm"""
+    ready = readiness.all_ready()
+    return FastJSONResponse(
+        {"ready": ready, "service": "service1", "dependencies": readiness.stats()},
+        status_code=200 if ready else 503
+    )
+
+@app.on_event("startup")
+async def startup():
+    readiness.start()
+    loop_monitor.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    readiness.stop()
+    loop_monitor.stop()
+    result_cache.close()
+    await close_shared_client()
+
+@app.get("/stats")
+async def get_stats():
+    """Request coalescing, result cache, shared memory and event loop statistics"""
+    return {"service": "service1", "single_flight": single_flight.stats(), "result_cache": result_cache.stats(),
+            "shm": shared_payloads.stats(), "event_loop": loop_monitor.stats()}
+
+def text_payload(payload: dict, text: Callable[[], str], handle: Optional[dict]) -> dict:
+    """payload plus its text, either as a shared memory handle or inline"""
+    return {**payload, "text_shm": handle} if handle is not None else {**payload, "text": text()}
+
+async def forward_to_service2(client: httpx.AsyncClient, build: Callable[[Optional[dict]], dict],
+                              segment: Optional[Segment] = None, offset: int = 0,
+                              length: Optional[int] = None) -> dict:
+    """
+    Send one request down the Service 2 → 3 → 4 chain. build(handle) gives
+    the payload, with the text handed off as the given part of segment when
+    there is a handle (see SharedPayloads.post_json).
+    """
+    if COMPLETION_MODE == "direct":
+        return await forward_for_direct_completion(client, build, segment, offset, length)
+    
+    response = await shared_payloads.post_json(
+        client,
+        f"{SERVICE2_URL}/preprocess",
+        build,
+        segment,
+        offset,
+        length
+    )
+    raise_for_status(response)
+    return response_json(response)
+
+async def forward_for_direct_completion(client: httpx.AsyncClient, build: Callable[[Optional[dict]], dict],
+                                        segment: Optional[Segment], offset: int,
+                                        length: Optional[int]) -> dict:
+    """
+    Direct-return mode: Service 2 only acknowledges the request, and the
+    result (or a stage's error) arrives on /complete/{completion_id}
+    """
+    completion_id = uuid.uuid4().hex
+    future = asyncio.get_running_loop().create_future()
+    pending_completions[completion_id] = future
+    try:
+        response = await shared_payloads.post_json(
+            client,
+            f"{SERVICE2_URL}/preprocess",
+            lambda handle: {**build(handle), "callback_url": f"{CALLBACK_URL}/complete/{completion_id}"},
+            segment,
+            offset,
+            length
+        )
+        raise_for_status(response)
+        result = await asyncio.wait_for(future, min(COMPLETION_TIMEOUT, remaining_timeout(COMPLETION_TIMEOUT)))
+    finally:
+        pending_completions.pop(completion_id, None)
+    
+    if result.get("status") == "error":
+        raise RuntimeError(result.get("message", "Pipeline failed"))
+    return result
+
+async def scatter_gather(client: httpx.AsyncClient, request: TextRequest) -> dict:
+    """
+    Cut a large document at word boundaries, send the chunks concurrently
+    through the Service 2 load balancer as one job, and fetch the report
+    service4 merged from every chunk's analysis
+    """
+    num_chunks = min(SCATTER_MAX_CHUNKS, math.ceil(len(request.text) / SCATTER_CHUNK_SIZE))
+    data = request.text.encode("utf-8")
+    chunks = split_text(data, num_chunks)
+    job_id = f"{request.request_id}-{uuid.uuid4().hex[:8]}"
+    logger.info(f"[Service 1] Scattering {request.request_id} into {len(chunks)} chunks")
+    
+    # The document is written to shared memory once, chunks are handed off as slices of it
+    handoff = shared_payloads.use_for(SERVICE2_URL, len(data))
+    with shared_payloads.create(data) if handoff else nullcontext() as segment:
+        results = await asyncio.gather(*[
+            forward_to_service2(client, partial(text_payload, {
+                "request_id": f"{request.request_id}_chunk{chunk.index}",
+                "job_id": job_id,
+                "chunk_index": chunk.index,
+                "total_chunks": len(chunks)
+            }, chunk.text), segment, chunk.start, chunk.size)
+            for chunk in chunks
+        ])
+    word_count = sum(result.get("word_count", 0) for result in results)
+    
+    timeout = remaining_timeout(60.0)
+    response = await client.get(f"{SERVICE4_URL}/reduce/{job_id}", headers=deadline_headers(timeout), timeout=timeout)
+    raise_for_status(response)
+    merged = response_json(response)
+    
+    if not merged.get("complete") or merged.get("word_count") != word_count:
+        raise RuntimeError(f"Merged report for job {job_id} is incomplete "
+                           f"({merged.get('chunks_received')}/{len(chunks)} chunks)")
+    if not merged.get("exact", True):
+        logger.warning(f"[Service 1] Merged top words for job {job_id} are approximate")
+    
+    logger.info(f"[Service 1] Gathered {len(chunks)} chunks for {request.request_id}")
+    return {
+        "status": "success",
+        "message": f"Pipeline completed ({len(chunks)} chunks)",
+        "word_count": merged["word_count"],
+        "report": merged.get("report", ""),
+        "top_words": merged.get("top_words", [])
+    }
+
+async def run_pipeline(request: TextRequest) -> dict:
+    """Run one request through the pipeline, scattering large documents"""
+    logger.info(f"[Service 1] Forwarding to Service 2 at {SERVICE2_URL}")
+    
+    client = shared_client()
+    # Chunks of a client-side job are never split again
+    if SCATTER_THRESHOLD and len(request.text) >= SCATTER_THRESHOLD and request.job_id is None:
+        result = await scatter_gather(client, request)
+    else:
+        handoff = shared_payloads.use_for(SERVICE2_URL, len(request.text))
+        with shared_payloads.create(request.text.encode("utf-8")) if handoff else nullcontext() as segment:
+            result = await forward_to_service2(client, partial(text_payload, {
+                "request_id": request.request_id,
+                **job_fields(request)
+            }, lambda: request.text), segment)
+    logger.info(f"[Service 1] Received response from Service 2")
+    return result
+
 @app.post("/process")
 async def process_text(request: TextRequest) -> TextResponse:
     """
@@ -40,31 +247,25 @@ async def process_text(request: TextRequest) -> TextResponse:
     logger.info(f"[Service 1] Text length: {len(request.text)} characters")
     
     try:
-        # Forward to Service 2
-        logger.info(f"[Service 1] Forwarding to Service 2 at {SERVICE2_URL}")
+        key = content_key({"text": request.text, **job_fields(request)}, RESULT_CACHE_VERSION)
+        # Chunks of a client-side job must reach the Service 4 reducer
+        cacheable = request.job_id is None
+        result = await result_cache.get(key) if cacheable else None
+        if result is not None:
+            logger.info(f"[Service 1] Serving {request.request_id} from the result cache")
+        else:
+            if SINGLE_FLIGHT:
+                result = await single_flight.run(key, lambda: run_pipeline(request))
+            else:
+                result = await run_pipeline(request)
+            if cacheable and result.get("status", "success") == "success":
+                await result_cache.put(key, result)
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{SERVICE2_URL}/preprocess",
-                json={
-                    "text": request.text,
-                    "request_id": request.request_id
-                },
-                timeout=60.0
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            logger.info(f"[Service 1] Received response from Service 2")
-            
-            return TextResponse(
-                status=result.get("status", "success"),
-                message=result.get("message", "Pipeline completed"),
-                word_count=result.get("word_count", 0),
-                report=result.get("report", ""),
-                top_words=result.get("top_words", [])
-            )
+        return trusted_response(TextResponse, result, status="success", message="Pipeline completed", word_count=0)
     
+    except DeadlineExceeded as e:
+        logger.error(f"[Service 1] Giving up: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
     except httpx.HTTPError as e:
         logger.error(f"[Service 1] HTTP Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Service 2 error: {str(e)}")
@@ -72,7 +273,18 @@ async def process_text(request: TextRequest) -> TextResponse:
         logger.error(f"[Service 1] Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/complete/{completion_id}")
+async def complete(completion_id: str, result: dict):
+    """
+    Direct-return mode: receives the final result of a pending request
+    """
+    future = pending_completions.get(completion_id)
+    if future is None or future.done():
+        raise HTTPException(status_code=404, detail=f"No pending request for completion {completion_id}")
+    future.set_result(result)
+    return {"status": "ok"}
+
 if __name__ == "__main__":
-    import uvicorn
-    logger.info(f"[Service 1] Starting on port {SERVICE_PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=SERVICE_PORT)
+    from common.launcher import run
+    # Pending direct-mode completions live in process memory
+    run("app:app", SERVICE_PORT, "Service 1", stateful=COMPLETION_MODE == "direct")
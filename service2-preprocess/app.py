@@ -1,23 +1,78 @@
 import os
+import sys
 import logging
 import re
-from fastapi import FastAPI, HTTPException
+from contextlib import nullcontext
+from functools import partial
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Optional, Tuple, Union
 import httpx
 
+# Shared helpers live next to app.py in the containers and at the repository
+# root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.chunk_cache import ChunkCache, content_chunks, use_incremental
+from common.completion import accepted, completion_fields, deliver_error
+from common.compression import CompressionMiddleware, response_json
+from common.deadline import DeadlineExceeded, DeadlineMiddleware, raise_for_status
+from common.http_pool import close_shared_client, service_url, shared_client
+from common.jobs import job_fields
+from common.loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from common.memory import MemoryProfiler
+from common.offload import OffloadQueueFull, StageExecutor
+from common.profiling import ProfilingMiddleware, router as profiling_router
+from common.readiness import ReadinessTracker
+from common.responses import FastJSONResponse, trusted_response
+from common.shm import HANDOFF_UNAVAILABLE_STATUS, Segment, SharedPayloadUnavailable, SharedPayloads
+from common.tokens import encode_ids, pack_tokens
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Service 2 - Preprocessing")
+app = FastAPI(title="Service 2 - Preprocessing", default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoopMonitorMiddleware)
+app.include_router(profiling_router)
 
 # Configuration
-SERVICE3_URL = os.getenv("SERVICE3_URL", "http://service3-loadbalancer:8063")
+SERVICE3_URL = service_url(os.getenv("SERVICE3_URL", "http://service3-loadbalancer:8063"))
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8052))
+# "text" forwards the cleaned text, "tokens" tokenizes once here and forwards
+# a vocabulary plus packed token-id array to Service 3
+ANALYSIS_PAYLOAD = os.getenv("ANALYSIS_PAYLOAD", "text")
+
+# Large documents are cleaned off the event loop, see common/offload.py
+stage_executor = StageExecutor("Service 2")
+
+# Opt-in per-request peak memory (MEMORY_PROFILING), see common/memory.py
+memory = MemoryProfiler("Service 2")
+
+# Cleaned text per content-defined chunk, see common/chunk_cache.py
+chunk_cache = ChunkCache("Service 2")
+
+# Large payloads arrive from Service 1 and go on to Service 3 through shared
+# memory (SHM_HANDOFF), see common/shm.py
+shared_payloads = SharedPayloads("Service 2")
+
+# Downstream services that must be ready (and pre-connected) before this one is
+readiness = ReadinessTracker("Service 2", {"service3": SERVICE3_URL})
+loop_monitor = LoopMonitor("Service 2")
 
 class PreprocessRequest(BaseModel):
-    text: str
+    text: str = ""
     request_id: str
+    # Shared memory handle to the text, set instead of text, see common/shm.py
+    text_shm: Optional[dict] = None
+    # Set when the request is one chunk of a multi-chunk job
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+    total_chunks: Optional[int] = None
+    # Set in direct-return mode, see common/completion.py
+    callback_url: Optional[str] = None
 
 class PreprocessResponse(BaseModel):
     status: str
@@ -39,49 +94,169 @@ def clean_text(text: str) -> str:
     
     return text
 
+def clean_text_incremental(text: str) -> str:
+    """
+    clean_text over content-defined chunks, reusing the cleaned text of
+    chunks seen before. Chunks end at whitespace, so joining the non-empty
+    cleaned chunks with single spaces gives exactly clean_text(text).
+    """
+    parts = []
+    cleaned_chunks = 0
+    for key, chunk in content_chunks(text.encode("utf-8")):
+        cleaned = chunk_cache.get(key)
+        if cleaned is None:
+            cleaned = clean_text(str(chunk, "utf-8"))
+            chunk_cache.put(key, cleaned, len(chunk))
+            cleaned_chunks += 1
+        if cleaned:
+            parts.append(cleaned)
+    logger.info(f"[Service 2] Cleaned {cleaned_chunks} new chunks, reused the rest")
+    return " ".join(parts)
+
+def prepare_analysis_payload(text: Union[str, memoryview], handoff: bool = False) -> Tuple[dict, Optional[Segment]]:
+    """
+    CPU-bound part of the stage: clean the text (given as str or UTF-8) and
+    build the Service 3 payload. When handing off, the cleaned text or the
+    token ids are written to a shared memory segment instead of the payload.
+    """
+    if not isinstance(text, str):
+        text = str(text, "utf-8")
+    cleaned_text = clean_text_incremental(text) if use_incremental(len(text)) else clean_text(text)
+    if ANALYSIS_PAYLOAD == "tokens":
+        tokens, packed = pack_tokens(cleaned_text.split())
+        if handoff:
+            return {"tokens": tokens}, shared_payloads.create(packed)
+        return {"tokens": {**tokens, "ids": encode_ids(packed)}}, None
+    if handoff:
+        # Cleaned text is plain ASCII
+        return {}, shared_payloads.create(cleaned_text.encode("ascii"))
+    return {"text": cleaned_text}, None
+
+def analysis_payload(payload: dict, segment: Optional[Segment], handle: Optional[dict]) -> dict:
+    """The Service 3 payload, with the part written to segment as a handle or (read back) inline"""
+    if segment is None:
+        return payload
+    if "tokens" in payload:
+        ids = {"ids_shm": handle} if handle is not None else {"ids": encode_ids(segment.read())}
+        return {**payload, "tokens": {**payload["tokens"], **ids}}
+    if handle is not None:
+        return {**payload, "text_shm": handle}
+    return {**payload, "text": segment.read().decode("ascii")}
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "service2"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: ready once Service 3 answers /ready and connections to it are warm"""
+    ready = readiness.all_ready()
+    return FastJSONResponse(
+        {"ready": ready, "service": "service2", "dependencies": readiness.stats()},
+        status_code=200 if ready else 503
+    )
+
+@app.on_event("startup")
+async def startup():
+    readiness.start()
+    loop_monitor.start()
+
+@app.get("/stats")
+async def get_stats():
+    """Stage executor (including its queue depth), chunk cache, shared memory, memory and event loop statistics"""
+    return {"service": "service2", "executor": stage_executor.stats(), "chunk_cache": chunk_cache.stats(),
+            "shm": shared_payloads.stats(), "memory": memory.stats(), "event_loop": loop_monitor.stats()}
+
+@app.on_event("shutdown")
+async def shutdown():
+    readiness.stop()
+    loop_monitor.stop()
+    stage_executor.shutdown()
+    await close_shared_client()
+
+def attach_text(request: PreprocessRequest):
+    """The shared memory text of the request, if it has one (421 when it cannot be attached here)"""
+    if request.text_shm is None:
+        return None
+    try:
+        return shared_payloads.attach(request.text_shm)
+    except SharedPayloadUnavailable as e:
+        logger.warning(f"[Service 2] {str(e)}, asking for {request.request_id} inline")
+        raise HTTPException(status_code=HANDOFF_UNAVAILABLE_STATUS, detail=str(e))
+
+async def preprocess_and_forward(request: PreprocessRequest, source=None) -> dict:
+    """
+    Clean the text (or the attached shared memory source) and forward it to
+    Service 3, returning Service 3's response
+    """
+    text = source.view if source is not None else request.text
+    handoff = shared_payloads.use_for(SERVICE3_URL, len(text))
+    try:
+        payload, segment = await memory.run(request.request_id, "preprocess", partial(stage_executor.run, len(text)),
+                                            prepare_analysis_payload, text, handoff)
+    finally:
+        if source is not None:
+            source.close()
+    if "tokens" in payload:
+        tokens = payload["tokens"]
+        logger.info(f"[Service 2] Encoded {len(tokens['vocabulary'])} distinct tokens ({tokens['typecode']} ids)")
+    elif segment is not None:
+        logger.info(f"[Service 2] Cleaned text length: {segment.size} characters (shared memory)")
+    else:
+        logger.info(f"[Service 2] Cleaned text length: {len(payload['text'])} characters")
+    
+    payload.update({"request_id": request.request_id, **job_fields(request), **completion_fields(request)})
+    
+    # Forward to Service 3
+    logger.info(f"[Service 2] Forwarding to Service 3 at {SERVICE3_URL}")
+    
+    with segment if segment is not None else nullcontext():
+        response = await shared_payloads.post_json(
+            shared_client(),
+            f"{SERVICE3_URL}/analyze",
+            partial(analysis_payload, payload, segment),
+            segment
+        )
+    raise_for_status(response)
+    
+    result = response_json(response)
+    logger.info(f"[Service 2] Received response from Service 3")
+    return result
+
+async def complete_in_background(request: PreprocessRequest, source=None):
+    """Direct-return mode: run the stage after acknowledging, report failures to the entry point"""
+    try:
+        await preprocess_and_forward(request, source)
+    except Exception as e:
+        logger.error(f"[Service 2] Error: {str(e)}")
+        await deliver_error(request.callback_url, f"Service 2 error: {str(e)}")
+
 @app.post("/preprocess")
-async def preprocess_text(request: PreprocessRequest) -> PreprocessResponse:
+async def preprocess_text(request: PreprocessRequest, background_tasks: BackgroundTasks) -> PreprocessResponse:
     """
     Preprocess text: clean and normalize, then forward to Service 3
     """
     logger.info(f"[Service 2] Received request {request.request_id}")
-    logger.info(f"[Service 2] Original text length: {len(request.text)} characters")
+    source = attach_text(request)
+    logger.info(f"[Service 2] Original text length: {len(source.view) if source else len(request.text)} "
+                f"{'bytes (shared memory)' if source else 'characters'}")
+    
+    if request.callback_url:
+        background_tasks.add_task(complete_in_background, request, source)
+        return PreprocessResponse(**accepted("Service 2"))
     
     try:
-        # Clean text
-        cleaned_text = clean_text(request.text)
-        logger.info(f"[Service 2] Cleaned text length: {len(cleaned_text)} characters")
-        
-        # Forward to Service 3
-        logger.info(f"[Service 2] Forwarding to Service 3 at {SERVICE3_URL}")
+        result = await preprocess_and_forward(request, source)
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{SERVICE3_URL}/analyze",
-                json={
-                    "text": cleaned_text,
-                    "request_id": request.request_id
-                },
-                timeout=60.0
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            logger.info(f"[Service 2] Received response from Service 3")
-            
-            return PreprocessResponse(
-                status=result.get("status", "success"),
-                message=result.get("message", "Preprocessing completed"),
-                word_count=result.get("word_count", 0),
-                report=result.get("report", ""),
-                top_words=result.get("top_words", [])
-            )
+        return trusted_response(PreprocessResponse, result, status="success", message="Preprocessing completed", word_count=0)
     
+    except OffloadQueueFull as e:
+        logger.error(f"[Service 2] Overloaded: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
+    except DeadlineExceeded as e:
+        logger.error(f"[Service 2] Giving up: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
     except httpx.HTTPError as e:
         logger.error(f"[Service 2] HTTP Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Service 3 error: {str(e)}")
@@ -90,6 +265,5 @@ async def preprocess_text(request: PreprocessRequest) -> PreprocessResponse:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
-    import uvicorn
-    logger.info(f"[Service 2] Starting on port {SERVICE_PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=SERVICE_PORT)
+    from common.launcher import run
+    run("app:app", SERVICE_PORT, "Service 2")
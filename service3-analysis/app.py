@@ -1,23 +1,91 @@
 import os
+import sys
+import hashlib
 import logging
 from collections import Counter
-from fastapi import FastAPI, HTTPException
+from functools import partial
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Optional
 import httpx
 
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by the "numpy" analysis engine
+    np = None
+
+# Shared helpers live next to app.py in the containers and at the repository
+# root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.batching import MicroBatcher
+from common.chunk_cache import ChunkCache, content_chunks, use_incremental
+from common.completion import accepted, completion_fields, deliver_error
+from common.compression import CompressionMiddleware, post_json, response_json
+from common.deadline import DeadlineExceeded, DeadlineMiddleware, raise_for_status, remaining_timeout
+from common.http_pool import close_shared_client, service_url, shared_client
+from common.jobs import job_fields
+from common.loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from common.memory import MemoryProfiler
+from common.offload import OffloadQueueFull, StageExecutor
+from common.profiling import ProfilingMiddleware, router as profiling_router
+from common.readiness import ReadinessTracker
+from common.responses import FastJSONResponse, trusted_response
+from common.shm import HANDOFF_UNAVAILABLE_STATUS, SharedPayloadUnavailable, SharedPayloads
+from common.tokens import decode_tokens
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Service 3 - Analysis")
+app = FastAPI(title="Service 3 - Analysis", default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoopMonitorMiddleware)
+app.include_router(profiling_router)
 
 # Configuration
-SERVICE4_URL = os.getenv("SERVICE4_URL", "http://service4-loadbalancer:8064")
+SERVICE4_URL = service_url(os.getenv("SERVICE4_URL", "http://service4-loadbalancer:8064"))
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8053))
+# "python" counts with collections.Counter, "numpy" factorizes tokens into
+# integer codes and counts them with vectorized bincount/argpartition
+ANALYSIS_ENGINE = os.getenv("ANALYSIS_ENGINE", "python")
+TOP_K = int(os.getenv("TOP_K", 10))
+
+if ANALYSIS_ENGINE == "numpy" and np is None:
+    logger.warning("[Service 3] numpy is not installed, falling back to the python analysis engine")
+    ANALYSIS_ENGINE = "python"
+
+# Large documents are analyzed off the event loop, see common/offload.py
+stage_executor = StageExecutor("Service 3")
+
+# Opt-in per-request peak memory (MEMORY_PROFILING), see common/memory.py
+memory = MemoryProfiler("Service 3")
+
+# Word counts per content-defined chunk and per run of leading chunks,
+# see common/chunk_cache.py
+chunk_cache = ChunkCache("Service 3")
+
+# Large payloads arrive from Service 2 through shared memory (SHM_HANDOFF), see common/shm.py
+shared_payloads = SharedPayloads("Service 3")
+
+# Downstream services that must be ready (and pre-connected) before this one is
+readiness = ReadinessTracker("Service 3", {"service4": SERVICE4_URL})
+loop_monitor = LoopMonitor("Service 3")
 
 class AnalysisRequest(BaseModel):
-    text: str
+    text: str = ""
     request_id: str
+    # Dictionary-encoded alternative to text, see common/tokens.py
+    tokens: Optional[dict] = None
+    # Shared memory handle to the text, set instead of text, see common/shm.py
+    text_shm: Optional[dict] = None
+    # Set when the request is one chunk of a multi-chunk job
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+    total_chunks: Optional[int] = None
+    # Set in direct-return mode, see common/completion.py
+    callback_url: Optional[str] = None
 
 class AnalysisResponse(BaseModel):
     status: str
@@ -38,65 +106,358 @@ def analyze_text(text: str) -> tuple:
     # Count frequencies
     word_freq = Counter(words)
     
-    # Get top 10 words
-    top_words = word_freq.most_common(10)
+    # Get top k words
+    top_words = word_freq.most_common(TOP_K)
+    
+    logger.info(f"[Service 3] Word count: {word_count}")
+    logger.info(f"[Service 3] Unique words: {len(word_freq)}")
+    logger.info(f"[Service 3] Top words: {top_words[:5]}")
+    
+    return word_count, top_words, dict(word_freq)
+
+def analyze_text_incremental(text: str) -> tuple:
+    """
+    analyze_text over content-defined chunks. Word counts of chunks seen
+    before come from the cache, and so do the merged counts of the longest
+    run of leading chunks seen before, so a document that only grew at the
+    end costs about as much as the appended text. Counts are merged in
+    document order, so ties in the top words come out as in analyze_text.
+    Returns: (word_count, top_words_list, word_frequencies_dict)
+    """
+    chunks = list(content_chunks(text.encode("utf-8")))
+    # prefix_keys[i] identifies chunks[0..i]
+    prefix_keys = []
+    digest = hashlib.blake2b(digest_size=16)
+    for key, _ in chunks:
+        digest.update(key.encode("ascii"))
+        prefix_keys.append(f"prefix:{digest.hexdigest()}")
+    
+    word_freq = Counter()
+    start = 0
+    for i in range(len(chunks) - 2, -1, -1):
+        merged = chunk_cache.get(prefix_keys[i])
+        if merged is not None:
+            word_freq = Counter(merged)
+            start = i + 1
+            break
+    
+    for i in range(start, len(chunks)):
+        key, chunk = chunks[i]
+        partial = chunk_cache.get(key)
+        if partial is None:
+            partial = Counter(str(chunk, "utf-8").split())
+            chunk_cache.put(key, partial, len(chunk))
+        word_freq.update(partial)
+        # Everything but the last chunk, which is where a growing document changes
+        if i == len(chunks) - 2:
+            chunk_cache.put(prefix_keys[i], Counter(word_freq), 100 * len(word_freq))
     
+    word_count = sum(word_freq.values())
+    top_words = word_freq.most_common(TOP_K)
+    
+    logger.info(f"[Service 3] Counted {len(chunks) - start} of {len(chunks)} chunks, reused the rest")
     logger.info(f"[Service 3] Word count: {word_count}")
     logger.info(f"[Service 3] Unique words: {len(word_freq)}")
     logger.info(f"[Service 3] Top words: {top_words[:5]}")
     
     return word_count, top_words, dict(word_freq)
 
+def analyze_tokens(vocabulary: list, token_ids) -> tuple:
+    """
+    Analyze a dictionary-encoded token stream by counting integer ids.
+    Ids are assigned in order of first occurrence, so ties in the top words
+    come out in the same order as analyze_text on the equivalent text.
+    Returns: (word_count, top_words_list, word_frequencies_dict)
+    """
+    word_count = len(token_ids)
+    
+    # Count frequencies over the integer array
+    id_freq = Counter(token_ids)
+    
+    # Get top k words
+    top_words = [(vocabulary[token_id], count) for token_id, count in id_freq.most_common(TOP_K)]
+    word_freq = {vocabulary[token_id]: count for token_id, count in id_freq.items()}
+    
+    logger.info(f"[Service 3] Word count: {word_count}")
+    logger.info(f"[Service 3] Unique words: {len(word_freq)}")
+    logger.info(f"[Service 3] Top words: {top_words[:5]}")
+    
+    return word_count, top_words, word_freq
+
+def count_codes_numpy(codes, vocabulary: list) -> tuple:
+    """
+    Count integer token codes (assigned in order of first occurrence) with
+    numpy. Produces the same top words as Counter.most_common, including the
+    order of ties, without sorting the whole vocabulary.
+    Returns: (word_count, top_words_list, word_frequencies_dict, statistics_dict)
+    """
+    word_count = int(codes.size)
+    counts = np.bincount(codes, minlength=len(vocabulary))
+    
+    # Partial selection of the top k: take every code strictly above the
+    # k-th largest count, then fill up with the earliest codes tied with it
+    k = min(TOP_K, counts.size)
+    if k > 0:
+        kth_count = np.partition(counts, counts.size - k)[counts.size - k]
+        above = np.flatnonzero(counts > kth_count)
+        tied = np.flatnonzero(counts == kth_count)[:k - above.size]
+        candidates = np.concatenate((above, tied))
+        # Highest count first, earliest first occurrence among equal counts
+        candidates = candidates[np.lexsort((candidates, -counts[candidates]))]
+        top_words = [(vocabulary[code], int(counts[code])) for code in candidates]
+    else:
+        top_words = []
+    
+    # Bulk statistics over the per-word counts (one pass over the vocabulary,
+    # none over the tokens): words per power-of-two frequency bucket
+    statistics = {}
+    if counts.size:
+        buckets = np.bincount(np.log2(counts).astype(np.int64))
+        statistics = {
+            "hapax_legomena": int(buckets[0]),
+            "frequency_histogram": {
+                (str(1 << i) if i == 0 else f"{1 << i}-{(1 << (i + 1)) - 1}"): n
+                for i, n in enumerate(buckets.tolist()) if n
+            }
+        }
+    
+    word_freq = dict(zip(vocabulary, counts.tolist()))
+    
+    logger.info(f"[Service 3] Word count: {word_count}")
+    logger.info(f"[Service 3] Unique words: {len(word_freq)}")
+    logger.info(f"[Service 3] Top words: {top_words[:5]}")
+    
+    return word_count, top_words, word_freq, statistics
+
+def analyze_text_numpy(text: str) -> tuple:
+    """
+    Analyze text with the numpy engine: factorize tokens into integer codes
+    in a single pass, then count the codes
+    """
+    vocabulary = {}
+    codes = np.fromiter(
+        (vocabulary.setdefault(word, len(vocabulary)) for word in text.split()),
+        dtype=np.int64
+    )
+    return count_codes_numpy(codes, list(vocabulary))
+
+def analyze_tokens_numpy(vocabulary: list, token_ids) -> tuple:
+    """Analyze a dictionary-encoded token stream with the numpy engine (zero-copy view of the ids)"""
+    codes = np.frombuffer(token_ids, dtype=f"u{token_ids.itemsize}") if len(token_ids) else np.empty(0, np.int64)
+    return count_codes_numpy(codes, vocabulary)
+
+def run_analysis(request: "AnalysisRequest", source=None) -> tuple:
+    """
+    Analyze the request's text or tokens with the configured engine, taking
+    the text or the token ids from the attached shared memory source if any
+    (token ids are read in place)
+    Returns: (word_count, top_words_list, word_frequencies_dict, statistics_dict)
+    """
+    if request.tokens is not None:
+        vocabulary, token_ids = decode_tokens(request.tokens, source.view if source is not None else None)
+        logger.info(f"[Service 3] Token ids: {len(token_ids)}, vocabulary: {len(vocabulary)}")
+        if ANALYSIS_ENGINE == "numpy":
+            return analyze_tokens_numpy(vocabulary, token_ids)
+        return analyze_tokens(vocabulary, token_ids) + ({},)
+    
+    text = str(source.view, "utf-8") if source is not None else request.text
+    logger.info(f"[Service 3] Text length: {len(text)} characters")
+    if ANALYSIS_ENGINE == "numpy":
+        return analyze_text_numpy(text)
+    if use_incremental(len(text)):
+        return analyze_text_incremental(text) + ({},)
+    return analyze_text(text) + ({},)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "service3"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: ready once Service 4 answers /ready and connections to it are warm"""
+    ready = readiness.all_ready()
+    return FastJSONResponse(
+        {"ready": ready, "service": "service3", "dependencies": readiness.stats()},
+        status_code=200 if ready else 503
+    )
+
+@app.on_event("startup")
+async def startup():
+    readiness.start()
+    loop_monitor.start()
+
+@app.get("/stats")
+async def get_stats():
+    """
+    Stage executor (including its queue depth), micro-batching, chunk cache,
+    shared memory, memory and event loop statistics
+    """
+    return {"service": "service3", "executor": stage_executor.stats(), "micro_batch": batcher.stats(),
+            "chunk_cache": chunk_cache.stats(), "shm": shared_payloads.stats(), "memory": memory.stats(),
+            "event_loop": loop_monitor.stats()}
+
+@app.on_event("shutdown")
+async def shutdown():
+    readiness.stop()
+    loop_monitor.stop()
+    stage_executor.shutdown()
+    await close_shared_client()
+
+def shared_handle(request: AnalysisRequest) -> Optional[dict]:
+    """Shared memory handle to the request's text or token ids, if it has one"""
+    return request.text_shm or (request.tokens or {}).get("ids_shm")
+
+def request_size(request: AnalysisRequest) -> int:
+    handle = shared_handle(request)
+    if handle is not None:
+        return int(handle["length"])
+    return len(request.tokens["ids"]) if request.tokens is not None else len(request.text)
+
+def attach_input(request: AnalysisRequest):
+    """The shared memory input of the request, if it has one (421 when it cannot be attached here)"""
+    handle = shared_handle(request)
+    if handle is None:
+        return None
+    try:
+        return shared_payloads.attach(handle)
+    except SharedPayloadUnavailable as e:
+        logger.warning(f"[Service 3] {str(e)}, asking for {request.request_id} inline")
+        raise HTTPException(status_code=HANDOFF_UNAVAILABLE_STATUS, detail=str(e))
+
+def analyze_batch(requests: list) -> list:
+    """run_analysis over a micro-batch, with the exception in place of a failed request's result"""
+    results = []
+    for request in requests:
+        try:
+            results.append(run_analysis(request))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def report_payload(request: AnalysisRequest, analysis: tuple) -> dict:
+    """Service 4 /report payload for a request's analysis"""
+    word_count, top_words, word_freq, statistics = analysis
+    analysis_data = {
+        "word_count": word_count,
+        "top_words": top_words,
+        "word_frequencies": word_freq,
+        "unique_words": len(word_freq),
+        "top_k": TOP_K
+    }
+    if statistics:
+        analysis_data["statistics"] = statistics
+    return {
+        "analysis": analysis_data,
+        "request_id": request.request_id,
+        **job_fields(request),
+        **completion_fields(request)
+    }
+
+async def analyze_and_forward(request: AnalysisRequest, source=None) -> dict:
+    """
+    Analyze the text (or the attached shared memory source) and forward the
+    analysis to Service 4, returning Service 4's response
+    """
+    # Analyze text
+    try:
+        analysis = await memory.run(
+            request.request_id, "analysis", partial(stage_executor.run, request_size(request)), run_analysis,
+            request, source
+        )
+    finally:
+        if source is not None:
+            source.close()
+    word_count, top_words, _, _ = analysis
+    
+    # Forward to Service 4
+    logger.info(f"[Service 3] Forwarding to Service 4 at {SERVICE4_URL}")
+    
+    response = await post_json(
+        shared_client(),
+        f"{SERVICE4_URL}/report",
+        report_payload(request, analysis),
+        timeout=remaining_timeout(60.0)
+    )
+    raise_for_status(response)
+    
+    result = response_json(response)
+    logger.info(f"[Service 3] Received response from Service 4")
+    return {"word_count": word_count, "top_words": top_words, **result}
+
+async def analyze_and_forward_batch(requests: list) -> list:
+    """
+    Analyze a micro-batch in one stage dispatch and fetch its reports from
+    Service 4 in one call. Returns one result (or exception) per request.
+    """
+    batch_id = f"batch-{requests[0].request_id}+{len(requests) - 1}"
+    logger.info(f"[Service 3] Analyzing {batch_id} ({len(requests)} requests)")
+    analyses = await memory.run(
+        batch_id, "analysis_batch", partial(stage_executor.run, sum(map(request_size, requests))),
+        analyze_batch, requests
+    )
+    
+    results = list(analyses)
+    analyzed = [i for i, analysis in enumerate(analyses) if not isinstance(analysis, Exception)]
+    if not analyzed:
+        return results
+    
+    logger.info(f"[Service 3] Forwarding {len(analyzed)} analyses of {batch_id} to Service 4 at {SERVICE4_URL}")
+    response = await post_json(
+        shared_client(),
+        f"{SERVICE4_URL}/report/batch",
+        {"request_id": batch_id, "reports": [report_payload(requests[i], analyses[i]) for i in analyzed]},
+        timeout=remaining_timeout(60.0)
+    )
+    raise_for_status(response)
+    
+    for i, result in zip(analyzed, response_json(response)["results"]):
+        if result["status"] == "error":
+            results[i] = RuntimeError(f"Service 4 error: {result['message']}")
+        else:
+            word_count, top_words, _, _ = analyses[i]
+            results[i] = {"word_count": word_count, "top_words": top_words, **result}
+    logger.info(f"[Service 3] Received {len(analyzed)} reports of {batch_id} from Service 4")
+    return results
+
+# Opt-in micro-batching of concurrent small requests (MICRO_BATCH), see common/batching.py
+batcher = MicroBatcher("Service 3", analyze_and_forward_batch)
+
+async def complete_in_background(request: AnalysisRequest, source=None):
+    """Direct-return mode: run the stage after acknowledging, report failures to the entry point"""
+    try:
+        await analyze_and_forward(request, source)
+    except Exception as e:
+        logger.error(f"[Service 3] Error: {str(e)}")
+        await deliver_error(request.callback_url, f"Service 3 error: {str(e)}")
+
 @app.post("/analyze")
-async def analyze_request(request: AnalysisRequest) -> AnalysisResponse:
+async def analyze_request(request: AnalysisRequest, background_tasks: BackgroundTasks) -> AnalysisResponse:
     """
     Analyze text: perform word frequency analysis and forward to Service 4
     """
     logger.info(f"[Service 3] Received request {request.request_id}")
-    logger.info(f"[Service 3] Text length: {len(request.text)} characters")
+    source = attach_input(request)
+    
+    if request.callback_url:
+        background_tasks.add_task(complete_in_background, request, source)
+        return AnalysisResponse(**accepted("Service 3"))
     
     try:
-        # Analyze text
-        word_count, top_words, word_freq = analyze_text(request.text)
-        
-        # Prepare analysis data for Service 4
-        analysis_data = {
-            "word_count": word_count,
-            "top_words": top_words,
-            "word_frequencies": word_freq,
-            "unique_words": len(word_freq)
-        }
-        
-        # Forward to Service 4
-        logger.info(f"[Service 3] Forwarding to Service 4 at {SERVICE4_URL}")
+        # Chunks of a job are reduced on the Service 4 instance holding the job, so never batched
+        if request.job_id is None and source is None and batcher.accepts(request_size(request)):
+            result = await batcher.submit(request, remaining_timeout(60.0))
+        else:
+            result = await analyze_and_forward(request, source)
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{SERVICE4_URL}/report",
-                json={
-                    "analysis": analysis_data,
-                    "request_id": request.request_id
-                },
-                timeout=60.0
-            )
-            response.raise_for_status()
-            
-            result = response.json()
-            logger.info(f"[Service 3] Received response from Service 4")
-            
-            return AnalysisResponse(
-                status=result.get("status", "success"),
-                message=result.get("message", "Analysis completed"),
-                word_count=result.get("word_count", word_count),
-                report=result.get("report", ""),
-                top_words=result.get("top_words", top_words)
-            )
+        return trusted_response(AnalysisResponse, result, status="success", message="Analysis completed")
     
+    except OffloadQueueFull as e:
+        logger.error(f"[Service 3] Overloaded: {str(e)}")
+        raise HTTPException(status_code=503, detail=str(e))
+    except DeadlineExceeded as e:
+        logger.error(f"[Service 3] Giving up: {str(e)}")
+        raise HTTPException(status_code=504, detail=str(e))
     except httpx.HTTPError as e:
         logger.error(f"[Service 3] HTTP Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Service 4 error: {str(e)}")
@@ -105,6 +466,5 @@ async def analyze_request(request: AnalysisRequest) -> AnalysisResponse:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
-    import uvicorn
-    logger.info(f"[Service 3] Starting on port {SERVICE_PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=SERVICE_PORT)
+    from common.launcher import run
+    run("app:app", SERVICE_PORT, "Service 3")
@@ -1,19 +1,64 @@
 import os
+import sys
+import zlib
+import random
 import logging
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 import httpx
-from typing import List
+from typing import Dict, List, Optional, Tuple
+
+# Shared helpers live next to app.py in the containers and at the repository
+# root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.chunk_cache import DOCUMENT_KEY_HEADER
+from common.completion import completion_fields
+from common.compression import CompressionMiddleware, encode_body
+from common.deadline import DeadlineExceeded, DeadlineMiddleware, deadline_headers, remaining_timeout
+from common.http_pool import close_shared_client, service_url, shared_client
+from common.jobs import job_fields
+from common.loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from common.profiling import ProfilingMiddleware, router as profiling_router
+from common.readiness import ReadinessTracker
+from common.responses import FastJSONResponse, RawJSONResponse
+from common.retry_budget import RetryBudget
+from common.shm import HANDOFF_UNAVAILABLE_STATUS
+from common.singleflight import SingleFlight, content_key
+from common.size_classes import SizeClassQueueFull, SizeClassRouter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Service 3 - Load Balancer")
+app = FastAPI(title="Service 3 - Load Balancer", default_response_class=FastJSONResponse)
+
+# Pass-through mode forwards request bodies (compressed or not) to the
+# instances untouched and relays their raw responses without re-encoding
+LB_PASSTHROUGH = os.getenv("LB_PASSTHROUGH", "false").lower() == "true"
+PASSTHROUGH_REQUEST_HEADERS = ("content-type", "content-encoding", "accept-encoding", "x-request-id", "x-job-id",
+                               DOCUMENT_KEY_HEADER)
+PASSTHROUGH_RESPONSE_HEADERS = ("content-type", "content-encoding")
+# Identical concurrent requests share one call to an instance
+LB_SINGLE_FLIGHT = os.getenv("LB_SINGLE_FLIGHT", "false").lower() == "true"
+
+app.add_middleware(CompressionMiddleware, decompress_requests=not LB_PASSTHROUGH)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoopMonitorMiddleware)
+app.include_router(profiling_router)
 
 class AnalysisRequest(BaseModel):
-    text: str
+    text: str = ""
     request_id: str
+    tokens: Optional[dict] = None
+    # Shared memory handle to the text, see common/shm.py
+    text_shm: Optional[dict] = None
+    # Set when the request is one chunk of a multi-chunk job
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+    total_chunks: Optional[int] = None
+    # Set in direct-return mode, see common/completion.py
+    callback_url: Optional[str] = None
 
 class AnalysisResponse(BaseModel):
     status: str
@@ -25,40 +70,149 @@ class AnalysisResponse(BaseModel):
 class LoadBalancer:
     def __init__(self, instances: List[str]):
         self.instances = instances
-        self.current_index = 0
+        # Round-robin position per size class (None: all instances)
+        self.current_index: Dict[Optional[str], int] = {}
         self.instance_stats = {instance: {'requests': 0, 'errors': 0} for instance in instances}
+        self.single_flight = SingleFlight("Load Balancer 3")
+        self.retry_budget = RetryBudget()
+        # Instances receive traffic once they report ready, ramping up through slow start
+        self.readiness = ReadinessTracker(
+            "Load Balancer 3", {instance: service_url(instance) for instance in instances}
+        )
+        self.size_router = SizeClassRouter("Load Balancer 3", instances)
         logger.info(f"[Load Balancer 3] Initialized with {len(instances)} instances:")
         for instance in instances:
             logger.info(f"  - {instance}")
     
-    async def route_request(self, request_data: dict) -> dict:
-        """Route request to available instance using round-robin"""
-        start_index = self.current_index
-        attempts = 0
-        
+    async def route_request(self, request_data: dict,
+                            accept_encoding: Optional[str] = None) -> Tuple[httpx.Response, bytes]:
+        """
+        Route request to available instance using round-robin. The caller's
+        Accept-Encoding is forwarded, so the raw response body can be relayed
+        to it without being decoded and re-encoded here.
+        """
         request_id = request_data.get('request_id', 'unknown')
         text_size = len(request_data.get('text', ''))
         logger.info(f"[Load Balancer 3] Routing request {request_id} ({text_size} chars)")
         
+        async def send():
+            body, headers = encode_body(request_data)
+            headers["accept-encoding"] = accept_encoding or "identity"
+            return await self.forward(body, headers, request_id, affinity_key=headers.get(DOCUMENT_KEY_HEADER))
+        
+        if LB_SINGLE_FLIGHT:
+            return await self.single_flight.run(content_key(request_data, accept_encoding), send)
+        return await send()
+    
+    def next_instance(self, size_class: Optional[str] = None) -> str:
+        """
+        Next ready instance for the size class in round-robin order.
+        Instances still in slow start are skipped with a probability that
+        shrinks as they ramp up. A class none of whose instances is ready
+        borrows from all instances.
+        """
+        instances = self.size_router.instances.get(size_class, self.instances)
+        fallback = None
+        for _ in range(len(instances)):
+            index = self.current_index.get(size_class, 0) % len(instances)
+            instance = instances[index]
+            self.current_index[size_class] = (index + 1) % len(instances)
+            weight = self.readiness.weight(instance)
+            if weight >= 1.0 or (weight > 0 and random.random() < weight):
+                return instance
+            if weight > 0 and fallback is None:
+                fallback = instance
+        if fallback is None:
+            if size_class is not None:
+                logger.warning(f"[Load Balancer 3] No ready {size_class} instances, using any instance")
+                return self.next_instance()
+            raise HTTPException(status_code=503, detail="No ready Service 3 instances")
+        return fallback
+    
+    def affinity_instance(self, affinity_key: str, size_class: Optional[str] = None) -> str:
+        """
+        The instance a document's requests go to, so its chunks are found in
+        that instance's cache. Falls back to round-robin while it is not ready.
+        """
+        instances = self.size_router.instances.get(size_class, self.instances)
+        instance = instances[zlib.crc32(affinity_key.encode("utf-8")) % len(instances)]
+        if self.readiness.is_ready(instance):
+            return instance
+        return self.next_instance(size_class)
+    
+    def attempt_timeout(self, request_id: str, attempts: int) -> float:
+        """
+        Timeout for the next attempt: what is left of the request's deadline.
+        Retries must also be covered by the retry budget.
+        """
+        try:
+            timeout = remaining_timeout(60.0)
+        except DeadlineExceeded as e:
+            logger.error(f"[Load Balancer 3] 💥 Giving up on {request_id} after {attempts} attempts: {str(e)}")
+            raise HTTPException(status_code=504, detail=f"{str(e)} after {attempts} attempts")
+        if attempts > 0 and not self.retry_budget.try_withdraw():
+            error_msg = f"Retry budget exhausted after {attempts} attempts"
+            logger.error(f"[Load Balancer 3] 💥 {error_msg} for {request_id}")
+            raise HTTPException(status_code=503, detail=error_msg)
+        return timeout
+    
+    async def forward(self, body: bytes, headers: dict, request_id: str,
+                      affinity_key: Optional[str] = None) -> Tuple[httpx.Response, bytes]:
+        """
+        Send a raw request body to available instance using round-robin
+        within its size class, once the class has a free slot. The first
+        attempt for a request with an affinity key (a document key) goes to
+        that document's instance.
+        Returns the response and its raw, still-encoded body.
+        """
+        size_class = self.size_router.classify(len(body))
+        try:
+            async with self.size_router.admit(size_class, remaining_timeout(60.0)):
+                return await self.forward_attempts(body, headers, request_id, affinity_key, size_class)
+        except SizeClassQueueFull as e:
+            logger.error(f"[Load Balancer 3] 💥 Rejecting {request_id}: {str(e)}")
+            raise HTTPException(status_code=503, detail=str(e))
+        except DeadlineExceeded as e:
+            logger.error(f"[Load Balancer 3] 💥 Giving up on {request_id} waiting for a {size_class} slot")
+            raise HTTPException(status_code=504, detail=str(e))
+    
+    async def forward_attempts(self, body: bytes, headers: dict, request_id: str, affinity_key: Optional[str],
+                               size_class: Optional[str]) -> Tuple[httpx.Response, bytes]:
+        attempts = 0
+        self.retry_budget.deposit()
+        
         while attempts < len(self.instances):
-            instance = self.instances[self.current_index]
-            self.current_index = (self.current_index + 1) % len(self.instances)
+            timeout = self.attempt_timeout(request_id, attempts)
+            if affinity_key is not None and attempts == 0:
+                instance = self.affinity_instance(affinity_key, size_class)
+            else:
+                instance = self.next_instance(size_class)
             
-            logger.info(f"[Load Balancer 3] → Sending to {instance}")
+            logger.info(f"[Load Balancer 3] → Sending {request_id} to {instance} ({len(body)} bytes, {size_class or 'any'})")
             self.instance_stats[instance]['requests'] += 1
             
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        f"http://{instance}/analyze",
-                        json=request_data,
-                        timeout=60.0
-                    )
+                async with shared_client().stream(
+                    "POST",
+                    f"{service_url(instance)}/analyze",
+                    content=body,
+                    headers={**headers, **deadline_headers(timeout)},
+                    timeout=timeout
+                ) as response:
+                    if response.status_code == 504:
+                        # Out of time downstream, another instance will not do better
+                        raise HTTPException(status_code=504, detail=f"Deadline exceeded at {instance}")
+                    if response.status_code == HANDOFF_UNAVAILABLE_STATUS:
+                        # Instances share a host (or not), the sender resends the payload inline
+                        raise HTTPException(status_code=HANDOFF_UNAVAILABLE_STATUS,
+                                            detail=f"{instance} cannot attach shared memory")
                     response.raise_for_status()
-                    result = response.json()
+                    raw = b"".join([chunk async for chunk in response.aiter_raw()])
                     logger.info(f"[Load Balancer 3] ✓ Success from {instance}")
-                    return result
+                    return response, raw
             
+            except HTTPException:
+                raise
             except httpx.HTTPError as e:
                 self.instance_stats[instance]['errors'] += 1
                 logger.error(f"[Load Balancer 3] ✗ Error from {instance}: {str(e)}")
@@ -81,34 +235,91 @@ SERVICE3_INSTANCES = [
     "service3c:8067",
     "service3d:8069"
 ]
+if os.getenv("SERVICE3_INSTANCES"):
+    # Comma-separated host:port list or URLs (e.g. unix:///run/rest/service3a.sock)
+    SERVICE3_INSTANCES = os.getenv("SERVICE3_INSTANCES").split(",")
 
 lb = LoadBalancer(SERVICE3_INSTANCES)
+loop_monitor = LoopMonitor("Load Balancer 3")
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "service3-loadbalancer"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: ready once an instance is ready and connections to it are warm"""
+    ready = lb.readiness.any_ready()
+    return FastJSONResponse(
+        {"ready": ready, "service": "service3-loadbalancer", "instances": lb.readiness.stats()},
+        status_code=200 if ready else 503
+    )
+
+@app.on_event("startup")
+async def startup():
+    lb.readiness.start()
+    loop_monitor.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    lb.readiness.stop()
+    loop_monitor.stop()
+    await close_shared_client()
+
+async def passthrough_request(request: Request) -> Response:
+    """
+    Pass-through endpoint: forwards the raw body to Service 3 instances
+    """
+    request_id = request.headers.get("x-request-id", "unknown")
+    logger.info(f"[Load Balancer 3] Received pass-through request {request_id}")
+    
+    try:
+        headers = {k: v for k, v in request.headers.items() if k in PASSTHROUGH_REQUEST_HEADERS}
+        response, raw = await lb.forward(await request.body(), headers, request_id,
+                                         affinity_key=request.headers.get(DOCUMENT_KEY_HEADER))
+        return Response(
+            content=raw,
+            status_code=response.status_code,
+            headers={k: v for k, v in response.headers.items() if k in PASSTHROUGH_RESPONSE_HEADERS}
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[Load Balancer 3] Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+if LB_PASSTHROUGH:
+    # Registered ahead of the validating endpoint below, so it takes precedence
+    app.add_api_route("/analyze", passthrough_request, methods=["POST"])
+
 @app.post("/analyze")
-async def analyze_request(request: AnalysisRequest) -> AnalysisResponse:
+async def analyze_request(request: AnalysisRequest, http_request: Request) -> AnalysisResponse:
     """
     Load balancer endpoint: routes requests to Service 3 instances
     """
     logger.info(f"[Load Balancer 3] Received request {request.request_id}")
     
     try:
-        result = await lb.route_request({
+        request_data = {
             "text": request.text,
-            "request_id": request.request_id
-        })
+            "request_id": request.request_id,
+            **job_fields(request),
+            **completion_fields(request)
+        }
+        if request.tokens is not None:
+            request_data["tokens"] = request.tokens
+        if request.text_shm is not None:
+            request_data["text_shm"] = request.text_shm
         
-        return AnalysisResponse(
-            status=result.get("status", "success"),
-            message=result.get("message", "Analysis completed"),
-            word_count=result.get("word_count", 0),
-            report=result.get("report", ""),
-            top_words=result.get("top_words", [])
+        response, raw = await lb.route_request(
+            request_data,
+            accept_encoding=http_request.headers.get("accept-encoding")
         )
+        
+        # Instances answer with exactly the fields of AnalysisResponse; relay the body as is
+        return RawJSONResponse(raw, response.status_code, response.headers.get("content-encoding"))
     
     except HTTPException:
         raise
@@ -121,11 +332,16 @@ async def get_stats():
     """Get load balancer statistics"""
     return {
         "instances": lb.instances,
-        "stats": lb.instance_stats
+        "stats": lb.instance_stats,
+        "single_flight": lb.single_flight.stats(),
+        "retry_budget": lb.retry_budget.stats(),
+        "readiness": lb.readiness.stats(),
+        "size_classes": lb.size_router.stats(),
+        "event_loop": loop_monitor.stats()
     }
 
 if __name__ == "__main__":
-    import uvicorn
+    from common.launcher import run
     port = int(os.getenv("SERVICE_PORT", 8063))
-    logger.info(f"[Service 3 Load Balancer] Starting on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Round-robin position and instance stats live in process memory
+    run("app:app", port, "Service 3 Load Balancer", stateful=True)
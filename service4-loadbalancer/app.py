@@ -1,19 +1,58 @@
 import os
+import sys
+import zlib
+import random
 import logging
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 import httpx
-from typing import List
+from typing import Dict, List, Optional, Tuple
+
+# Shared helpers live next to app.py in the containers and at the repository
+# root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.completion import completion_fields
+from common.compression import CompressionMiddleware, encode_body
+from common.deadline import DeadlineExceeded, DeadlineMiddleware, deadline_headers, remaining_timeout
+from common.http_pool import close_shared_client, service_url, shared_client
+from common.jobs import job_fields
+from common.loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from common.profiling import ProfilingMiddleware, router as profiling_router
+from common.readiness import ReadinessTracker
+from common.responses import FastJSONResponse, RawJSONResponse
+from common.retry_budget import RetryBudget
+from common.singleflight import SingleFlight, content_key
+from common.size_classes import SizeClassQueueFull, SizeClassRouter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Service 4 - Load Balancer")
+app = FastAPI(title="Service 4 - Load Balancer", default_response_class=FastJSONResponse)
+
+# Pass-through mode forwards request bodies (compressed or not) to the
+# instances untouched and relays their raw responses without re-encoding
+LB_PASSTHROUGH = os.getenv("LB_PASSTHROUGH", "false").lower() == "true"
+PASSTHROUGH_REQUEST_HEADERS = ("content-type", "content-encoding", "accept-encoding", "x-request-id", "x-job-id")
+PASSTHROUGH_RESPONSE_HEADERS = ("content-type", "content-encoding")
+# Identical concurrent requests share one call to an instance
+LB_SINGLE_FLIGHT = os.getenv("LB_SINGLE_FLIGHT", "false").lower() == "true"
+
+app.add_middleware(CompressionMiddleware, decompress_requests=not LB_PASSTHROUGH)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoopMonitorMiddleware)
+app.include_router(profiling_router)
 
 class ReportRequest(BaseModel):
     analysis: dict
     request_id: str
+    # Set when the request is one chunk of a multi-chunk job
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+    total_chunks: Optional[int] = None
+    # Set in direct-return mode, see common/completion.py
+    callback_url: Optional[str] = None
 
 class ReportResponse(BaseModel):
     status: str
@@ -22,42 +61,170 @@ class ReportResponse(BaseModel):
     report: str
     top_words: list = []
 
+class ReduceRequest(BaseModel):
+    job_id: str
+    chunk_index: int
+    total_chunks: Optional[int] = None
+    analysis: dict
+    request_id: str = ""
+
+class ReduceResponse(ReportResponse):
+    job_id: str
+    chunks_received: int
+    total_chunks: Optional[int] = None
+    complete: bool
+    exact: bool
+
 class LoadBalancer:
     def __init__(self, instances: List[str]):
         self.instances = instances
-        self.current_index = 0
+        # Round-robin position per size class (None: all instances)
+        self.current_index: Dict[Optional[str], int] = {}
         self.instance_stats = {instance: {'requests': 0, 'errors': 0} for instance in instances}
+        self.single_flight = SingleFlight("Load Balancer 4")
+        self.retry_budget = RetryBudget()
+        # Instances receive traffic once they report ready, ramping up through slow start
+        self.readiness = ReadinessTracker(
+            "Load Balancer 4", {instance: service_url(instance) for instance in instances}
+        )
+        self.size_router = SizeClassRouter("Load Balancer 4", instances)
         logger.info(f"[Load Balancer 4] Initialized with {len(instances)} instances:")
         for instance in instances:
             logger.info(f"  - {instance}")
     
-    async def route_request(self, request_data: dict) -> dict:
-        """Route request to available instance using round-robin"""
-        start_index = self.current_index
-        attempts = 0
-        
+    async def route_request(self, request_data: dict, path: str = "/report",
+                            accept_encoding: Optional[str] = None) -> Tuple[httpx.Response, bytes]:
+        """
+        Route request to available instance using round-robin (job affinity
+        for chunks). The caller's Accept-Encoding is forwarded, so the raw
+        response body can be relayed to it without being decoded and
+        re-encoded here.
+        """
         request_id = request_data.get('request_id', 'unknown')
         logger.info(f"[Load Balancer 4] Routing request {request_id}")
         
+        async def send():
+            body, headers = encode_body(request_data)
+            headers["accept-encoding"] = accept_encoding or "identity"
+            return await self.forward(body, headers, request_id, path=path,
+                                      affinity_key=request_data.get('job_id'))
+        
+        if LB_SINGLE_FLIGHT:
+            return await self.single_flight.run(content_key(request_data, path, accept_encoding), send)
+        return await send()
+    
+    def next_instance(self, size_class: Optional[str] = None) -> str:
+        """
+        Next ready instance for the size class in round-robin order.
+        Instances still in slow start are skipped with a probability that
+        shrinks as they ramp up. A class none of whose instances is ready
+        borrows from all instances.
+        """
+        instances = self.size_router.instances.get(size_class, self.instances)
+        fallback = None
+        for _ in range(len(instances)):
+            index = self.current_index.get(size_class, 0) % len(instances)
+            instance = instances[index]
+            self.current_index[size_class] = (index + 1) % len(instances)
+            weight = self.readiness.weight(instance)
+            if weight >= 1.0 or (weight > 0 and random.random() < weight):
+                return instance
+            if weight > 0 and fallback is None:
+                fallback = instance
+        if fallback is None:
+            if size_class is not None:
+                logger.warning(f"[Load Balancer 4] No ready {size_class} instances, using any instance")
+                return self.next_instance()
+            raise HTTPException(status_code=503, detail="No ready Service 4 instances")
+        return fallback
+    
+    def affinity_instance(self, start_index: int, attempts: int) -> str:
+        """The ready instance for an affinity request's given attempt, in a fixed order from start_index"""
+        ready = [
+            instance for instance in (self.instances[(start_index + i) % len(self.instances)]
+                                      for i in range(len(self.instances)))
+            if self.readiness.is_ready(instance)
+        ]
+        if attempts >= len(ready):
+            raise HTTPException(status_code=503, detail="No ready Service 4 instances")
+        return ready[attempts]
+    
+    def attempt_timeout(self, request_id: str, attempts: int) -> float:
+        """
+        Timeout for the next attempt: what is left of the request's deadline.
+        Retries must also be covered by the retry budget.
+        """
+        try:
+            timeout = remaining_timeout(60.0)
+        except DeadlineExceeded as e:
+            logger.error(f"[Load Balancer 4] 💥 Giving up on {request_id} after {attempts} attempts: {str(e)}")
+            raise HTTPException(status_code=504, detail=f"{str(e)} after {attempts} attempts")
+        if attempts > 0 and not self.retry_budget.try_withdraw():
+            error_msg = f"Retry budget exhausted after {attempts} attempts"
+            logger.error(f"[Load Balancer 4] 💥 {error_msg} for {request_id}")
+            raise HTTPException(status_code=503, detail=error_msg)
+        return timeout
+    
+    async def forward(self, body: bytes, headers: dict, request_id: str, path: str = "/report",
+                      method: str = "POST", affinity_key: Optional[str] = None) -> Tuple[httpx.Response, bytes]:
+        """
+        Send a raw request body to available instance using round-robin.
+        Requests with an affinity key (a job id) always start at the same
+        instance, so every chunk of a job reaches the same reducer state.
+        Other requests use round-robin within their size class, once the
+        class has a free slot.
+        Returns the response and its raw, still-encoded body.
+        """
+        size_class = self.size_router.classify(len(body))
+        try:
+            async with self.size_router.admit(size_class, remaining_timeout(60.0)):
+                return await self.forward_attempts(body, headers, request_id, path, method, affinity_key, size_class)
+        except SizeClassQueueFull as e:
+            logger.error(f"[Load Balancer 4] 💥 Rejecting {request_id}: {str(e)}")
+            raise HTTPException(status_code=503, detail=str(e))
+        except DeadlineExceeded as e:
+            logger.error(f"[Load Balancer 4] 💥 Giving up on {request_id} waiting for a {size_class} slot")
+            raise HTTPException(status_code=504, detail=str(e))
+    
+    async def forward_attempts(self, body: bytes, headers: dict, request_id: str, path: str, method: str,
+                               affinity_key: Optional[str], size_class: Optional[str]) -> Tuple[httpx.Response, bytes]:
+        start_index = 0
+        if affinity_key is not None:
+            start_index = zlib.crc32(affinity_key.encode("utf-8")) % len(self.instances)
+        attempts = 0
+        self.retry_budget.deposit()
+        
         while attempts < len(self.instances):
-            instance = self.instances[self.current_index]
-            self.current_index = (self.current_index + 1) % len(self.instances)
+            timeout = self.attempt_timeout(request_id, attempts)
+            if affinity_key is not None:
+                instance = self.affinity_instance(start_index, attempts)
+            else:
+                instance = self.next_instance(size_class)
             
-            logger.info(f"[Load Balancer 4] → Sending to {instance}")
+            logger.info(f"[Load Balancer 4] → Sending {request_id} to {instance} ({len(body)} bytes, {size_class or 'any'})")
             self.instance_stats[instance]['requests'] += 1
             
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        f"http://{instance}/report",
-                        json=request_data,
-                        timeout=60.0
-                    )
+                async with shared_client().stream(
+                    method,
+                    f"{service_url(instance)}{path}",
+                    content=body,
+                    headers={**headers, **deadline_headers(timeout)},
+                    timeout=timeout
+                ) as response:
+                    if response.status_code == 404 and affinity_key is not None:
+                        # The instance owning the job does not know it, no other instance will
+                        raise HTTPException(status_code=404, detail=f"Unknown or expired job {affinity_key}")
+                    if response.status_code == 504:
+                        # Out of time downstream, another instance will not do better
+                        raise HTTPException(status_code=504, detail=f"Deadline exceeded at {instance}")
                     response.raise_for_status()
-                    result = response.json()
+                    raw = b"".join([chunk async for chunk in response.aiter_raw()])
                     logger.info(f"[Load Balancer 4] ✓ Success from {instance}")
-                    return result
+                    return response, raw
             
+            except HTTPException:
+                raise
             except httpx.HTTPError as e:
                 self.instance_stats[instance]['errors'] += 1
                 logger.error(f"[Load Balancer 4] ✗ Error from {instance}: {str(e)}")
@@ -80,33 +247,105 @@ SERVICE4_INSTANCES = [
     "service4c:8068",
     "service4d:8070"
 ]
+if os.getenv("SERVICE4_INSTANCES"):
+    # Comma-separated host:port list or URLs (e.g. unix:///run/rest/service4a.sock)
+    SERVICE4_INSTANCES = os.getenv("SERVICE4_INSTANCES").split(",")
 
 lb = LoadBalancer(SERVICE4_INSTANCES)
+loop_monitor = LoopMonitor("Load Balancer 4")
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "service4-loadbalancer"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint: ready once an instance is ready and connections to it are warm"""
+    ready = lb.readiness.any_ready()
+    return FastJSONResponse(
+        {"ready": ready, "service": "service4-loadbalancer", "instances": lb.readiness.stats()},
+        status_code=200 if ready else 503
+    )
+
+@app.on_event("startup")
+async def startup():
+    lb.readiness.start()
+    loop_monitor.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    lb.readiness.stop()
+    loop_monitor.stop()
+    await close_shared_client()
+
+async def passthrough_request(request: Request) -> Response:
+    """
+    Pass-through endpoint: forwards the raw body to Service 4 instances
+    """
+    request_id = request.headers.get("x-request-id", "unknown")
+    logger.info(f"[Load Balancer 4] Received pass-through request {request_id}")
+    
+    try:
+        headers = {k: v for k, v in request.headers.items() if k in PASSTHROUGH_REQUEST_HEADERS}
+        response, raw = await lb.forward(await request.body(), headers, request_id,
+                                         affinity_key=request.headers.get("x-job-id"))
+        return Response(
+            content=raw,
+            status_code=response.status_code,
+            headers={k: v for k, v in response.headers.items() if k in PASSTHROUGH_RESPONSE_HEADERS}
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[Load Balancer 4] Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+if LB_PASSTHROUGH:
+    # Registered ahead of the validating endpoint below, so it takes precedence
+    app.add_api_route("/report", passthrough_request, methods=["POST"])
+
 @app.post("/report")
-async def generate_request_report(request: ReportRequest) -> ReportResponse:
+async def generate_request_report(request: ReportRequest, http_request: Request) -> ReportResponse:
     """
     Load balancer endpoint: routes requests to Service 4 instances
     """
     logger.info(f"[Load Balancer 4] Received request {request.request_id}")
     
     try:
-        result = await lb.route_request({
+        response, raw = await lb.route_request({
             "analysis": request.analysis,
-            "request_id": request.request_id
-        })
+            "request_id": request.request_id,
+            **job_fields(request),
+            **completion_fields(request)
+        }, accept_encoding=http_request.headers.get("accept-encoding"))
         
-        return ReportResponse(
-            status=result.get("status", "success"),
-            message=result.get("message", "Report generated"),
-            word_count=result.get("word_count", 0),
-            report=result.get("report", ""),
-            top_words=result.get("top_words", [])
+        # Instances answer with exactly the fields of ReportResponse; relay the body as is
+        return RawJSONResponse(raw, response.status_code, response.headers.get("content-encoding"))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[Load Balancer 4] Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/report/batch")
+async def generate_batch_report(request: Request) -> Response:
+    """
+    Load balancer endpoint: routes a micro-batch of analyses from Service 3
+    to one Service 4 instance, relaying the body as is
+    """
+    request_id = request.headers.get("x-request-id", "unknown")
+    logger.info(f"[Load Balancer 4] Received batch {request_id}")
+    
+    try:
+        headers = {k: v for k, v in request.headers.items() if k in PASSTHROUGH_REQUEST_HEADERS}
+        response, raw = await lb.forward(await request.body(), headers, request_id, path="/report/batch")
+        return Response(
+            content=raw,
+            status_code=response.status_code,
+            headers={k: v for k, v in response.headers.items() if k in PASSTHROUGH_RESPONSE_HEADERS}
         )
     
     except HTTPException:
@@ -115,16 +354,63 @@ async def generate_request_report(request: ReportRequest) -> ReportResponse:
         logger.error(f"[Load Balancer 4] Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/reduce")
+async def reduce_chunk(request: ReduceRequest, http_request: Request) -> ReduceResponse:
+    """
+    Load balancer endpoint: routes a job's partial analyses to the Service 4
+    instance that holds the job
+    """
+    logger.info(f"[Load Balancer 4] Received chunk {request.chunk_index} of job {request.job_id}")
+    
+    try:
+        response, raw = await lb.route_request({
+            "job_id": request.job_id,
+            "chunk_index": request.chunk_index,
+            "total_chunks": request.total_chunks,
+            "analysis": request.analysis,
+            "request_id": request.request_id
+        }, path="/reduce", accept_encoding=http_request.headers.get("accept-encoding"))
+        return RawJSONResponse(raw, response.status_code, response.headers.get("content-encoding"))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[Load Balancer 4] Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/reduce/{job_id}")
+async def get_reduced_report(job_id: str, http_request: Request) -> ReduceResponse:
+    """
+    Load balancer endpoint: fetches a job's merged report from the Service 4
+    instance that holds the job
+    """
+    try:
+        headers = {"accept-encoding": http_request.headers.get("accept-encoding", "identity")}
+        response, raw = await lb.forward(b"", headers, job_id,
+                                         path=f"/reduce/{job_id}", method="GET", affinity_key=job_id)
+        return RawJSONResponse(raw, response.status_code, response.headers.get("content-encoding"))
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"[Load Balancer 4] Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/stats")
 async def get_stats():
     """Get load balancer statistics"""
     return {
         "instances": lb.instances,
-        "stats": lb.instance_stats
+        "stats": lb.instance_stats,
+        "single_flight": lb.single_flight.stats(),
+        "retry_budget": lb.retry_budget.stats(),
+        "readiness": lb.readiness.stats(),
+        "size_classes": lb.size_router.stats(),
+        "event_loop": loop_monitor.stats()
     }
 
 if __name__ == "__main__":
-    import uvicorn
+    from common.launcher import run
     port = int(os.getenv("SERVICE_PORT", 8064))
-    logger.info(f"[Service 4 Load Balancer] Starting on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Round-robin position and instance stats live in process memory
+    run("app:app", port, "Service 4 Load Balancer", stateful=True)
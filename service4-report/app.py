@@ -1,20 +1,66 @@
 import os
+import sys
+import time
+import heapq
 import logging
-from fastapi import FastAPI, HTTPException
+from collections import Counter
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from pydantic import BaseModel
+from typing import Dict, List, Optional
+
+# Shared helpers live next to app.py in the containers and at the repository
+# root during local development
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.completion import accepted, deliver, deliver_error
+from common.compression import CompressionMiddleware
+from common.deadline import DeadlineMiddleware
+from common.http_pool import close_shared_client
+from common.loop_monitor import LoopMonitor, LoopMonitorMiddleware
+from common.memory import MemoryProfiler
+from common.profiling import ProfilingMiddleware, router as profiling_router
+from common.readiness import ReadinessTracker
+from common.responses import FastJSONResponse, trusted_response
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Service 4 - Report")
+app = FastAPI(title="Service 4 - Report", default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoopMonitorMiddleware)
+app.include_router(profiling_router)
 
 # Configuration
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8054))
+# Streaming reducer: distinct words tracked per job, idle time before an
+# unfinished job is dropped, and number of jobs held at once
+REDUCER_CAPACITY = int(os.getenv("REDUCER_CAPACITY", 200000))
+REDUCER_JOB_TTL = float(os.getenv("REDUCER_JOB_TTL", 600))
+REDUCER_MAX_JOBS = int(os.getenv("REDUCER_MAX_JOBS", 256))
 
 class ReportRequest(BaseModel):
     analysis: dict
     request_id: str
+    # Set when the analysis is one chunk of a multi-chunk job
+    job_id: Optional[str] = None
+    chunk_index: Optional[int] = None
+    total_chunks: Optional[int] = None
+    # Set in direct-return mode, see common/completion.py
+    callback_url: Optional[str] = None
+
+class ReportBatchRequest(BaseModel):
+    """A micro-batch of analyses from Service 3, see common/batching.py"""
+    reports: List[ReportRequest]
+    request_id: str = ""
+
+class ReduceRequest(BaseModel):
+    job_id: str
+    chunk_index: int
+    total_chunks: Optional[int] = None
+    analysis: dict
+    request_id: str = ""
 
 class ReportResponse(BaseModel):
     status: str
@@ -23,6 +69,121 @@ class ReportResponse(BaseModel):
     report: str
     top_words: list = []
 
+class ReduceResponse(ReportResponse):
+    job_id: str
+    chunks_received: int
+    total_chunks: Optional[int] = None
+    complete: bool
+    exact: bool
+
+class JobState:
+    """
+    Running merge of the partial analyses of one job. Word frequencies are
+    kept for at most REDUCER_CAPACITY distinct words; beyond that the least
+    frequent are evicted and error_bound records how far any count may be
+    under-reported. word_count is always exact.
+    """
+    def __init__(self, job_id: str, total_chunks: Optional[int], top_k: int):
+        self.job_id = job_id
+        self.total_chunks = total_chunks
+        self.top_k = top_k
+        self.chunks = set()
+        self.word_count = 0
+        self.frequencies = Counter()
+        # (chunk_index, position in chunk) of each word's first occurrence,
+        # so ties order exactly as in an analysis of the whole document
+        self.first_seen: Dict[str, tuple] = {}
+        self.error_bound = 0
+        self.exact = True
+        self.updated = time.time()
+    
+    @property
+    def complete(self) -> bool:
+        return self.total_chunks is not None and len(self.chunks) >= self.total_chunks
+    
+    def merge(self, chunk_index: int, analysis: dict) -> bool:
+        """Merge one chunk's analysis; chunks that were already merged are ignored"""
+        if chunk_index in self.chunks:
+            return False
+        self.chunks.add(chunk_index)
+        self.updated = time.time()
+        self.word_count += analysis.get("word_count", 0)
+        self.top_k = max(self.top_k, analysis.get("top_k", self.top_k))
+        
+        frequencies = analysis.get("word_frequencies")
+        if frequencies is None:
+            # Only the chunk's top words are known, later counts are partial
+            frequencies = dict(analysis.get("top_words", []))
+            self.exact = False
+        
+        self.frequencies.update(frequencies)
+        for position, word in enumerate(frequencies):
+            key = (chunk_index, position)
+            if word not in self.first_seen or key < self.first_seen[word]:
+                self.first_seen[word] = key
+        
+        if len(self.frequencies) > REDUCER_CAPACITY:
+            self._evict()
+        return True
+    
+    def _evict(self):
+        kept = self.frequencies.most_common(REDUCER_CAPACITY + 1)
+        self.error_bound += kept.pop()[1]
+        self.exact = False
+        self.frequencies = Counter(dict(kept))
+        self.first_seen = {word: self.first_seen[word] for word, _ in kept}
+        logger.info(f"[Service 4] Job {self.job_id}: evicted to {REDUCER_CAPACITY} words (error bound {self.error_bound})")
+    
+    def analysis(self) -> dict:
+        """The merged analysis in the shape generate_report expects"""
+        top_words = heapq.nsmallest(
+            self.top_k,
+            self.frequencies.items(),
+            key=lambda item: (-item[1], self.first_seen[item[0]])
+        )
+        return {
+            "word_count": self.word_count,
+            "top_words": top_words,
+            "unique_words": len(self.frequencies),
+            "top_k": self.top_k
+        }
+
+class StreamingReducer:
+    """Per-job merge state, expired after REDUCER_JOB_TTL seconds without updates"""
+    def __init__(self):
+        self.jobs: Dict[str, JobState] = {}
+    
+    def expire(self):
+        now = time.time()
+        for job_id in [j for j, state in self.jobs.items() if now - state.updated > REDUCER_JOB_TTL]:
+            logger.info(f"[Service 4] Job {job_id} expired")
+            del self.jobs[job_id]
+        while len(self.jobs) > REDUCER_MAX_JOBS:
+            oldest = min(self.jobs, key=lambda j: self.jobs[j].updated)
+            logger.info(f"[Service 4] Job {oldest} dropped, too many jobs in flight")
+            del self.jobs[oldest]
+    
+    def merge(self, job_id: str, chunk_index: int, total_chunks: Optional[int], analysis: dict) -> JobState:
+        self.expire()
+        state = self.jobs.get(job_id)
+        if state is None:
+            state = self.jobs[job_id] = JobState(job_id, total_chunks, analysis.get("top_k", 10))
+        if total_chunks is not None:
+            state.total_chunks = total_chunks
+        if state.merge(chunk_index, analysis):
+            logger.info(f"[Service 4] Job {job_id}: merged chunk {chunk_index} ({len(state.chunks)}/{state.total_chunks or '?'})")
+        return state
+    
+    def get(self, job_id: str) -> Optional[JobState]:
+        self.expire()
+        return self.jobs.get(job_id)
+
+reducer = StreamingReducer()
+
+# No downstream dependencies: ready as soon as it serves
+readiness = ReadinessTracker("Service 4", {})
+loop_monitor = LoopMonitor("Service 4")
+
 def generate_report(analysis: dict) -> str:
     """
     Generate a formatted text report from analysis data
@@ -30,6 +191,8 @@ def generate_report(analysis: dict) -> str:
     word_count = analysis.get("word_count", 0)
     top_words = analysis.get("top_words", [])
     unique_words = analysis.get("unique_words", 0)
+    top_k = analysis.get("top_k", 10)
+    statistics = analysis.get("statistics", {})
     
     # Build report
     report_lines = [
@@ -41,8 +204,13 @@ def generate_report(analysis: dict) -> str:
         ""
     ]
     
+    if statistics:
+        report_lines.insert(-1, f"Words Occurring Once: {statistics.get('hapax_legomena', 0)}")
+        for bucket, words in statistics.get("frequency_histogram", {}).items():
+            report_lines.insert(-1, f"  {bucket} occurrences: {words} words")
+    
     if top_words:
-        report_lines.append("Top 10 Most Frequent Words:")
+        report_lines.append(f"Top {top_k} Most Frequent Words:")
         report_lines.append("-" * 70)
         for i, (word, count) in enumerate(top_words, 1):
             percentage = (count / word_count * 100) if word_count > 0 else 0
@@ -55,41 +223,149 @@ def generate_report(analysis: dict) -> str:
     
     return report
 
+# Opt-in per-request peak memory (MEMORY_PROFILING), see common/memory.py
+memory = MemoryProfiler("Service 4")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "service4"}
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness endpoint"""
+    ready = readiness.all_ready()
+    return FastJSONResponse(
+        {"ready": ready, "service": "service4", "dependencies": readiness.stats()},
+        status_code=200 if ready else 503
+    )
+
+@app.on_event("startup")
+async def startup():
+    readiness.start()
+    loop_monitor.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    readiness.stop()
+    loop_monitor.stop()
+    await close_shared_client()
+
+@app.get("/stats")
+async def get_stats():
+    """Memory and event loop statistics"""
+    return {"service": "service4", "memory": memory.stats(), "event_loop": loop_monitor.stats()}
+
+def build_report(request: ReportRequest) -> dict:
+    """Generate the report for a request, merging tagged chunks into their job"""
+    analysis = request.analysis
+    word_count = analysis.get("word_count", 0)
+    top_words = analysis.get("top_words", [])
+    
+    # Generate report
+    report = generate_report(analysis)
+    
+    logger.info(f"[Service 4] Report generated successfully")
+    
+    if request.job_id is not None and request.chunk_index is not None:
+        reducer.merge(request.job_id, request.chunk_index, request.total_chunks, analysis)
+    
+    return {
+        "status": "success",
+        "message": "Report generated successfully",
+        "word_count": word_count,
+        "report": report,
+        "top_words": top_words
+    }
+
+async def complete_in_background(request: ReportRequest):
+    """Direct-return mode: send the report straight to the entry point"""
+    try:
+        result = await memory.run(request.request_id, "report", None, build_report, request)
+    except Exception as e:
+        logger.error(f"[Service 4] Error: {str(e)}")
+        await deliver_error(request.callback_url, f"Service 4 error: {str(e)}")
+        return
+    if await deliver(request.callback_url, result):
+        logger.info(f"[Service 4] Delivered report for {request.request_id} to the entry point")
+
 @app.post("/report")
-async def generate_request_report(request: ReportRequest) -> ReportResponse:
+async def generate_request_report(request: ReportRequest, background_tasks: BackgroundTasks) -> ReportResponse:
     """
     Final service: generate formatted report from analysis data
     """
     logger.info(f"[Service 4] Received request {request.request_id}")
     
+    if request.callback_url:
+        background_tasks.add_task(complete_in_background, request)
+        return ReportResponse(report="", **accepted("Service 4"))
+    
     try:
-        analysis = request.analysis
-        word_count = analysis.get("word_count", 0)
-        top_words = analysis.get("top_words", [])
-        
-        # Generate report
-        report = generate_report(analysis)
-        
-        logger.info(f"[Service 4] Report generated successfully")
-        
-        return ReportResponse(
-            status="success",
-            message="Report generated successfully",
-            word_count=word_count,
-            report=report,
-            top_words=top_words
-        )
+        return trusted_response(ReportResponse, await memory.run(request.request_id, "report", None, build_report, request))
+    
+    except Exception as e:
+        logger.error(f"[Service 4] Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/report/batch")
+async def generate_batch_report(request: ReportBatchRequest) -> dict:
+    """
+    Reports for a micro-batch of analyses, one result per analysis in order.
+    A failed report is an error result and does not fail the rest.
+    """
+    logger.info(f"[Service 4] Received {request.request_id or 'batch'} of {len(request.reports)} requests")
+    
+    results = []
+    for report_request in request.reports:
+        try:
+            results.append(await memory.run(report_request.request_id, "report", None, build_report, report_request))
+        except Exception as e:
+            logger.error(f"[Service 4] Error on {report_request.request_id}: {str(e)}")
+            results.append({"status": "error", "message": str(e)})
+    return {"results": results}
+
+def reduce_response(state: JobState) -> FastJSONResponse:
+    analysis = state.analysis()
+    return trusted_response(ReduceResponse, {
+        "status": "complete" if state.complete else "partial",
+        "message": f"Merged {len(state.chunks)} of {state.total_chunks or 'unknown'} chunks",
+        "word_count": analysis["word_count"],
+        "report": generate_report(analysis),
+        "top_words": analysis["top_words"],
+        "job_id": state.job_id,
+        "chunks_received": len(state.chunks),
+        "total_chunks": state.total_chunks,
+        "complete": state.complete,
+        "exact": state.exact
+    })
+
+@app.post("/reduce")
+async def reduce_chunk(request: ReduceRequest) -> ReduceResponse:
+    """
+    Streaming reducer: merge one chunk's partial analysis into its job
+    """
+    logger.info(f"[Service 4] Received chunk {request.chunk_index} of job {request.job_id}")
+    
+    try:
+        state = await memory.run(request.request_id or request.job_id, "reduce", None, reducer.merge,
+                                 request.job_id, request.chunk_index, request.total_chunks, request.analysis)
+        return reduce_response(state)
     
     except Exception as e:
         logger.error(f"[Service 4] Error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/reduce/{job_id}")
+async def get_reduced_report(job_id: str) -> ReduceResponse:
+    """
+    Running (or, once every chunk arrived, final) merged report of a job
+    """
+    state = reducer.get(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired job {job_id}")
+    return reduce_response(state)
+
 if __name__ == "__main__":
-    import uvicorn
-    logger.info(f"[Service 4] Starting on port {SERVICE_PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=SERVICE_PORT)
+    from common.launcher import run
+    # Reducer jobs live in process memory
+    run("app:app", SERVICE_PORT, "Service 4", stateful=True)